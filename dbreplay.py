@@ -0,0 +1,217 @@
+#!/usr/local/bin/python
+
+#
+# Program: dbreplay.py
+#
+# Purpose:
+#
+#	Record/replay of database traffic, used to measure the number of
+#	database calls each input row of libraryload.py costs.
+#
+#	record: wrap() replaces db.sql with a version that counts each call
+#		and, given a trace file, appends the call and its result to it.
+#
+#	replay: this module is also a stand-in for the db module.
+#		After replay(traceFileName), sql() serves the recorded results,
+#		so libraryload.py (and loadlib/sourceloadlib) can be re-run offline.
+#		Statements executed without a result parser (inserts, updates,
+#		transaction control) are only counted, not matched: their text
+#		embeds the load date, so they differ from day to day.
+#
+# Usage:
+#
+#	record:	import db, dbreplay
+#		dbreplay.wrap(db, traceFileName)
+#
+#	replay:	import dbreplay
+#		sys.modules['db'] = dbreplay	# before loadlib/sourceloadlib are imported
+#		dbreplay.replay(traceFileName)
+#
+#	dbreplay.sqlCount is the number of statements executed (or served).
+#
+# Outputs:
+#
+#	A trace file: a stream of pickled (command, parser, execute, result) tuples.
+#
+# Implementation:
+#
+#	Modules:
+#
+#	def commandKey():	returns a hashable key for a statement
+#	def wrap():		counts (and optionally records) the calls of the db module
+#	def replay():		loads a trace file to serve sql() from
+#	def sql():		serves a recorded result
+#
+#	(and the remaining functions of the db interface used by the loads,
+#	which do nothing when replaying)
+#
+
+import sys
+import cPickle
+
+#globals
+
+sqlCount = 0		# statements executed or served
+
+traceFile = None	# file descriptor of the trace being recorded
+
+trace = []		# recorded calls being replayed
+traceIndex = 0		# next call expected, in recorded order
+unused = {}		# command -> list of indexes into trace not yet served
+
+logFD = None		# log file descriptor (replay)
+
+class ReplayError(Exception):
+    # Purpose: raised when a statement is not found in the trace
+    pass
+
+def commandKey(
+    command	# sql statement (string or list of strings)
+    ):
+    # Purpose: a hashable key for a statement
+    # Returns: string or tuple
+    # Assumes: nothing
+    # Effects: nothing
+    # Throws: nothing
+
+    if type(command) == type([]):
+        return tuple(command)
+
+    return command
+
+def wrap(
+    dbModule,			# db module
+    traceFileName = None	# trace file to record to (string), or None to only count
+    ):
+    # Purpose: replace dbModule.sql with a version which counts each executed
+    #          statement and, given a trace file, records it with its result
+    # Returns: nothing
+    # Assumes: nothing
+    # Effects: modifies dbModule; creates the trace file
+    # Throws: IOError if the trace file cannot be created
+
+    global traceFile
+
+    if traceFileName:
+        traceFile = open(traceFileName, 'wb')
+
+    realSql = dbModule.sql
+
+    def sql(command, parser = 'auto', execute = 1, **kw):
+        global sqlCount
+        result = realSql(command, parser, execute = execute, **kw)
+        if execute:
+            sqlCount = sqlCount + 1
+        if traceFile is not None:
+            cPickle.dump((command, parser, execute, result), traceFile, 2)
+        return result
+
+    dbModule.sql = sql
+
+    return
+
+def replay(
+    traceFileName	# trace file to replay (string)
+    ):
+    # Purpose: load a trace file; sql() then serves its results
+    # Returns: nothing
+    # Assumes: nothing
+    # Effects: initializes the trace
+    # Throws: IOError if the trace file cannot be read
+
+    global trace, traceIndex, unused
+
+    trace = []
+    fp = open(traceFileName, 'rb')
+    while 1:
+        try:
+            trace.append(cPickle.load(fp))
+        except EOFError:
+            break
+    fp.close()
+
+    traceIndex = 0
+    unused = {}
+    for i in range(len(trace)):
+        key = commandKey(trace[i][0])
+        if not unused.has_key(key):
+            unused[key] = []
+        unused[key].append(i)
+
+    return
+
+def sql(
+    command,		# sql statement (string or list of strings)
+    parser = 'auto',	# result parser
+    execute = 1,	# false to only log the statement
+    **kw
+    ):
+    # Purpose: serve the recorded result of a statement
+    #          the next recorded call is used if it is the same statement,
+    #          else the first unserved recording of the statement;
+    #          a statement without a parser returns nothing and is not looked up
+    # Returns: the recorded result
+    # Assumes: replay() has been called
+    # Effects: nothing
+    # Throws: ReplayError if the statement was not recorded
+
+    global sqlCount, traceIndex
+
+    if logFD is not None:
+        logFD.write(str(command) + '\n')
+
+    if not execute:
+        return None
+
+    sqlCount = sqlCount + 1
+
+    if parser is None:
+        return None
+
+    key = commandKey(command)
+    if not unused.has_key(key) or len(unused[key]) == 0:
+        raise ReplayError('Statement not in trace: %s' % (command))
+
+    indexes = unused[key]
+    if traceIndex in indexes:
+        i = traceIndex
+    else:
+        i = indexes[0]
+    indexes.remove(i)
+    traceIndex = i + 1
+
+    return trace[i][3]
+
+#
+# the rest of the db interface
+#
+
+def useOneConnection(value = 0):
+    return
+
+def set_sqlUser(user):
+    return
+
+def set_sqlPassword(password):
+    return
+
+def set_sqlPasswordFromFile(fileName):
+    return
+
+def set_sqlLogFunction(function):
+    return
+
+def sqlLogAll(*args, **kw):
+    return
+
+def set_sqlLogFD(fd):
+    global logFD
+    logFD = fd
+    return
+
+def get_sqlServer():
+    return 'replay'
+
+def get_sqlDatabase():
+    return 'replay'
+
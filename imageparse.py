@@ -14,7 +14,12 @@
 #	JSAM (TR 3404)
 #
 # Usage:
-#        imageparse.py -I input file
+#        imageparse.py -I input file [-C gz|bz2|xz] [-V vocabulary snapshot]
+#
+#	-I input file; may be gzip, bzip2 or xz compressed
+#	-C write the output and error files compressed
+#	-V validate translated values against a vocabulary snapshot (see libraryvocab.py);
+#	   rows with invalid values are written to the error file, not the output file
 #
 # Envvars:
 #
@@ -44,7 +49,7 @@
 #
 # Outputs:
 #
-#	A tab-delimited file in the libraryload.py format:
+#	A tab-delimited file (input file + .lib) in the libraryload.py format:
 #		field 1: Library Name
 #		field 2: Library Accession Name
 #		field 3: Library ID
@@ -76,7 +81,10 @@
 #	def showUsage():	prints usage of this program and exits
 #	def exit():		prints message to stderr and exists
 #	def init():		processes inputs; initializes globals
+#	def translate():	translates one combination of input values
+#	def validate():		validates translated values against the vocabulary snapshot
 #	def processFile():	processes input file
+#	def reportStats():	reports translation cache statistics
 #
 #	Algorithm:
 #
@@ -84,11 +92,17 @@
 #    		if a new record is encountered, write the previously parsed record
 #    		else parse each line and translate each value into a corresponding, valid MGI value
 #
+#	Each distinct combination of translated input values (organism, vector type, sex,
+#	strain, organ:tissue, stage:description) is translated once and cached; the number
+#	of distinct combinations and the cache hit rate are reported on stdout.
+#
 
 import sys
 import os
 import string
 import getopt
+import libraryio
+import libraryvocab
 
 #globals
 
@@ -110,6 +124,8 @@ tissueFileName = 'imagetissue.trans'
 ageFileName= 'imageage.trans'
 strainFileName= 'imagestrain.trans'
 
+snapshot = None		# vocabulary snapshot (see libraryvocab.py)
+
 tissueLookup = {}
 treatmentLookup = {}
 ageLookup = {}
@@ -121,6 +137,15 @@ sexLookup = {'':NS, 'unknown':NS, 'neither':NS,
 	     'both':'Pooled', 'male':'Male', 'female':'Female'}
 
 vectorLookup = {'plasmid':'Plasmid', 'phagemid':'Phagemid'}
+
+segmentType = 'cDNA'
+cellLine = NS
+
+# (translated output, snapshot validation errors),
+# keyed by the tuple of raw input values it was translated from
+translationCache = {}
+cacheHits = 0
+cacheMisses = 0
 		
 # Purpose: displays correct usage of this program
 # Returns: nothing
@@ -129,7 +154,7 @@ vectorLookup = {'plasmid':'Plasmid', 'phagemid':'Phagemid'}
 # Throws:  nothing
  
 def showUsage():
-    usage = 'usage: %s -I input file\n' % sys.argv[0]
+    usage = 'usage: %s -I input file [-C gz|bz2|xz] [-V vocabulary snapshot]\n' % sys.argv[0]
     exit(1, usage)
  
 # Purpose: 
@@ -164,33 +189,49 @@ def exit(
      
 def init():
     global inputFile, outputFile, errorFile, tissueFile, ageFile, strainFile
-    global tissueLookup, treatmentLookup, ageLookup
+    global tissueLookup, treatmentLookup, ageLookup, snapshot
      
     try:
-        optlist, args = getopt.getopt(sys.argv[1:], 'I:')
+        optlist, args = getopt.getopt(sys.argv[1:], 'I:C:V:')
     except:
         showUsage()
      
     inputFileName = ''
     outputFileName = ''
+    compression = None
+    snapshotFileName = ''
      
     for opt in optlist:
         if opt[0] == '-I':
             inputFileName = opt[1]
+        elif opt[0] == '-C':
+            compression = opt[1]
+        elif opt[0] == '-V':
+            snapshotFileName = opt[1]
         else:
     	    showUsage()
 
     if inputFileName == '':
         showUsage()
 
-    outputFileName = inputFileName + '.lib'
-    errorFileName = inputFileName + '.error'
+    if compression is not None and compression not in libraryio.COMPRESSIONS:
+        showUsage()
+
+    baseFileName = libraryio.stripCompression(inputFileName)
+    outputFileName = libraryio.outputName(baseFileName + '.lib', compression)
+    errorFileName = libraryio.outputName(baseFileName + '.error', compression)
 
     try:
-        inputFile = open(inputFileName, 'r')
+        inputFile = libraryio.openFile(inputFileName, 'r')
     except:
         exit(1, 'Could not open file %s\n' % inputFileName)
 		    
+    if snapshotFileName != '':
+        try:
+            snapshot = libraryvocab.readSnapshot(snapshotFileName)
+        except:
+            exit(1, 'Could not open file %s\n' % snapshotFileName)
+
     try:
         tissueFile = open(tissueFileName, 'r')
     except:
@@ -207,12 +248,12 @@ def init():
         exit(1, 'Could not open file %s\n' % strainFileName)
 		    
     try:
-        outputFile = open(outputFileName, 'w')
+        outputFile = libraryio.openFile(outputFileName, 'w')
     except:
         exit(1, 'Could not open file %s\n' % outputFileName)
 		    
     try:
-        errorFile = open(errorFileName, 'w')
+        errorFile = libraryio.openFile(errorFileName, 'w')
     except:
         exit(1, 'Could not open file %s\n' % errorFileName)
 		
@@ -241,79 +282,134 @@ def init():
 
     return
 
+# Purpose: translate one distinct combination of raw input values
+#          into the corresponding MGI values
+# Returns: tuple of (organism, vectorType, gender, strain, age, tissue, description)
+#          or None if the organism is not loaded
+# Assumes: nothing
+# Effects: nothing
+# Throws:  KeyError if the vector type or sex is not in its translation table
+
+def translate(
+    inOrganism,		# field 3: Organism (string)
+    inVectorType,	# field 8: V Type (string)
+    inSourceSex,	# field 16: Source Sex (string)
+    inStrain,		# field 20: Strain (string)
+    inOrgan,		# field 4: Organ (string)
+    inTissue,		# field 5: Tissue (string)
+    inSourceStage,	# field 17: Source Stage (string)
+    inSourceDesc	# field 18: Source Description (string)
+    ):
+
+    if not organismLookup.has_key(inOrganism):
+        return None
+
+    organism = organismLookup[inOrganism]
+
+    # use translation tables
+
+    vectorType = vectorLookup[inVectorType]
+    gender = sexLookup[inSourceSex]
+
+    if strainLookup.has_key(inStrain):
+        strain = strainLookup[inStrain]
+    else:
+        strain = inStrain
+
+    # use inSourceStage + inSourceDesc to resolve Age
+    lookupAge = inSourceStage + ':' + inSourceDesc
+    if ageLookup.has_key(lookupAge):
+        age = ageLookup[lookupAge]
+    else:
+        age = NS
+
+    # use inOrgan + inTissue to resolve Tissue
+    lookupTissue = inOrgan + ':' + inTissue
+    if tissueLookup.has_key(lookupTissue):
+        tissue = tissueLookup[lookupTissue]
+    else:
+        tissue = inOrgan
+
+    if treatmentLookup.has_key(lookupTissue):
+        description = treatmentLookup[lookupTissue]
+    else:
+#       description = inDescription
+        description = ''
+
+    return (organism, vectorType, gender, strain, age, tissue, description)
+
+# Purpose: validate translated values against the vocabulary snapshot
+# Returns: list of (vocabulary, term) not found in the snapshot
+# Assumes: nothing
+# Effects: nothing
+# Throws:  nothing
+
+def validate(
+    translated	# tuple returned by translate()
+    ):
+
+    if snapshot is None or translated is None:
+        return []
+
+    organism, vectorType, gender, strain, age, tissue, description = translated
+
+    return libraryvocab.validateRecord(snapshot, ['', logicalDBName, '', segmentType, \
+	vectorType, organism, strain, tissue, age, gender, cellLine, jnum, description, createdBy])
+
 # Purpose: read input file, write output file
+#          each distinct combination of translated input values is
+#          translated (and validated) once and the translated output is cached
+#          rows which fail validation are written to the error file
 # Returns: nothing
 # Assumes: nothing
 # Effects: reads input file, writes to output file
 # Throws:  nothing
 
 def processFile():
-    writeRecord = 0
+    global cacheHits, cacheMisses
+
+    lineNum = 0
 
     for line in inputFile.readlines():
 
+        lineNum = lineNum + 1
         tokens = string.split(line[:-1], TAB)
 
 	inLibraryName = tokens[0]
 	inLibraryID = tokens[1]
-	inOrganism = tokens[2]
-	inOrgan = tokens[3]
-	inTissue = tokens[4]
 #	inHost = tokens[5]
 #	inVector = tokens[6]
-	inVectorType = tokens[7]
 #	inRe3 = tokens[8]
 #	inRe5 = tokens[9]
-	inDescription = tokens[10]
+#	inDescription = tokens[10]
 #	inLinker3 = tokens[11]
 #	inLinker5 = tokens[12]
 #	inLibraryPriming = tokens[13]
 #	inSourceAge = tokens[14]
-	inSourceSex = tokens[15]
-	inSourceStage = tokens[16]
-	inSourceDesc = tokens[17]
 #	inSeqTag = tokens[18]
-	inStrain = tokens[19]
-
-        if not organismLookup.has_key(inOrganism):
-	    continue
-	else:
-	    organism = organismLookup[inOrganism]
-
-	segmentType = 'cDNA'
-        strain = NS
-        age = NS
-        cellLine = NS
-
-	# use translation tables
 
-	vectorType = vectorLookup[inVectorType]
-	gender = sexLookup[inSourceSex]
+	# Organism, V Type, Source Sex, Strain, Organ, Tissue, Source Stage, Source Description
+	key = (tokens[2], tokens[7], tokens[15], tokens[19], tokens[3], tokens[4], tokens[16], tokens[17])
 
-	if strainLookup.has_key(inStrain):
-	    strain = strainLookup[inStrain]
+	if translationCache.has_key(key):
+	    translated, errors = translationCache[key]
+	    cacheHits = cacheHits + 1
 	else:
-	    strain = inStrain
+	    translated = apply(translate, key)
+	    errors = validate(translated)
+	    translationCache[key] = (translated, errors)
+	    cacheMisses = cacheMisses + 1
 
-	# use inSourceStage + inSourceDesc to resolve Age
-	lookupAge = inSourceStage + ':' + inSourceDesc
-	if ageLookup.has_key(lookupAge):
-	    age = ageLookup[lookupAge]
-        else:
-	    age = NS
+	if translated is None:
+	    continue
 
-	# use inOrgan + inTissue to resolve Tissue
-	lookupTissue = inOrgan + ':' + inTissue
-	if tissueLookup.has_key(lookupTissue):
-	    tissue = tissueLookup[lookupTissue]
-        else:
-	    tissue = inOrgan
+	if len(errors) > 0:
+	    for vocabulary, term in errors:
+	        errorFile.write('Invalid %s (line: %d): %s, Library = %s\n' \
+		    % (vocabulary, lineNum, term, inLibraryName))
+	    continue
 
-	if treatmentLookup.has_key(lookupTissue):
-	    description = treatmentLookup[lookupTissue]
-        else:
-#	    description = inDescription
-	    description = ''
+	organism, vectorType, gender, strain, age, tissue, description = translated
 
         outputFile.write(inLibraryName + TAB + \
                          logicalDBName + TAB + \
@@ -332,11 +428,33 @@ def processFile():
 
     return
 
+# Purpose: report translation cache statistics
+# Returns: nothing
+# Assumes: processFile() has been called
+# Effects: writes the number of distinct input combinations
+#          and the cache hit rate to stdout
+# Throws:  nothing
+
+def reportStats():
+
+    total = cacheHits + cacheMisses
+    if total > 0:
+        hitRate = 100.0 * cacheHits / total
+    else:
+        hitRate = 0.0
+
+    sys.stdout.write('Lines Translated: %d\n' % (total))
+    sys.stdout.write('Distinct Combinations: %d\n' % (cacheMisses))
+    sys.stdout.write('Cache Hits: %d (%.1f%%)\n' % (cacheHits, hitRate))
+
+    return
+
 #
 # Main
 #
 
 init()
 processFile()
+reportStats()
 exit(0)
 
@@ -0,0 +1,389 @@
+#!/usr/local/bin/python
+
+#
+# Program: librarybench.py
+#
+# Purpose:
+#
+#	To measure the throughput of imageparse.py and niaparse.py on
+#	synthetic provider files of a given size and composition.
+#
+#	The generated files are deterministic for a given seed, so the output
+#	checksums of two runs (e.g. before and after a change to a parser)
+#	show whether the parser output is unchanged.
+#
+# Usage:
+#	librarybench.py -P image|nia [-n records] [-t hit rate] [-m malformed rate]
+#			[-k distinct values] [-s seed] [-r repeats] [-d work directory]
+#			[-V vocabulary snapshot]
+#
+#	-P parser to measure
+#	-n number of library records to generate (default 10000)
+#	-t fraction of records whose values are found in the translation
+#	   tables/rules of the parser (default 0.9)
+#	-m fraction of malformed records (default 0.01); see generateImage()/generateNIA()
+#	-k number of distinct values of each translated field (default 50);
+#	   controls the number of distinct combinations the parser translates
+#	-s random seed (default 1)
+#	-r number of times the parser is run; the best time is reported (default 3)
+#	-d directory the files are generated in (default: a new temporary directory)
+#	-V vocabulary snapshot passed to the parser (see libraryvocab.py)
+#
+# Outputs:
+#
+#	In the work directory: the generated input file (and, for IMAGE, its
+#	translation tables) and the output and error files of the parser.
+#
+#	On stdout, a tab-delimited line:
+#		parser, records, input lines, best seconds, lines per second,
+#		peak memory (KB), md5 of the output file, md5 of the error file
+#
+#	On stderr, the statistics the parser writes to its stdout
+#
+# Exit Codes:
+#
+#       0 = successful
+#       1 = error (including a parser failure)
+#
+# Implementation:
+#
+#	Modules:
+#
+#	def showUsage():	prints usage of this program and exits
+#	def pick():		picks a value from the translated or the untranslated pool
+#	def generateImage():	writes a synthetic IMAGE file and its translation tables
+#	def generateNIA():	writes a synthetic NIA file
+#	def runParser():	runs a parser once
+#	def checksum():		returns the md5 of a file
+#
+
+import sys
+import os
+import string
+import getopt
+import random
+import tempfile
+import subprocess
+import resource
+import time
+import hashlib
+
+#globals
+
+TAB = '\t'
+CRT = '\n'
+
+parsers = {'image':'imageparse.py', 'nia':'niaparse.py'}
+inputFileNames = {'image':'image.txt', 'nia':'NIA_Lib_Source_Info.txt'}
+
+# NIA Library IDs translated by niaparse.py
+niaLibraryIDs = ['cDNA30', 'cDNA31', 'cDNA32', 'cDNA33', 'cDNA36', 'cDNA37', 'cDNA41', 'cDNA46',
+	'cDNA43', 'cDNA44', 'cDNA39', 'cDNA34', 'cDNA42', 'cDNA49', 'cDNA40', 'cDNA24', 'cDNA27',
+	'cDNA28', 'cDNA26', 'cDNA35', 'cDNA12', 'cDNA11', 'cDNA14', 'cDNA15', 'cDNA16', 'cDNA17',
+	'cDNA7', 'cDNA18', 'cDNA19', 'cDNA20', 'cDNA2', 'L-S4', 'L-EII', 'cDNA54', 'cDNA55',
+	'cDNA57', 'cDNA58', 'cDNA59']
+
+# NIA strains translated by niaparse.py
+niaStrains = ['B5/EGFP transgenic ICR mice', 'TH-beta-gal transgenic mouse', 'C3H/He mice',
+	'129/Sv x 129/Sv-CP', 'CD1']
+
+# IMAGE Source Sex values translated by imageparse.py
+imageSexes = ['', 'unknown', 'neither', 'both', 'male', 'female']
+
+def showUsage():
+    # Purpose: displays correct usage of this program
+    # Returns: nothing
+    # Assumes: nothing
+    # Effects: exits with status of 1
+    # Throws: nothing
+
+    sys.stderr.write('usage: %s -P image|nia [-n records] [-t hit rate] [-m malformed rate]\n' % sys.argv[0] + \
+	'\t[-k distinct values] [-s seed] [-r repeats] [-d work directory] [-V vocabulary snapshot]\n')
+    sys.exit(1)
+
+def pick(
+    rng,	# random.Random
+    hitRate,	# fraction of translated values (float)
+    hits,	# translated values (list)
+    misses	# untranslated values (list)
+    ):
+    # Purpose: pick a translated value with probability hitRate, else an untranslated one
+    # Returns: a value
+    # Assumes: nothing
+    # Effects: nothing
+    # Throws: nothing
+
+    if rng.random() < hitRate:
+        return rng.choice(hits)
+
+    return rng.choice(misses)
+
+def generateImage(
+    dirName,		# work directory (string)
+    records,		# number of records (integer)
+    hitRate,		# fraction of translated values (float)
+    malformedRate,	# fraction of malformed records (float)
+    distinct,		# distinct values per field (integer)
+    rng			# random.Random
+    ):
+    # Purpose: write a synthetic 20-column IMAGE file, and the translation tables
+    #          imageparse.py reads from its working directory.
+    #          a malformed record is one imageparse.py reads but does not load:
+    #          its organism is not translated, so the record is dropped.
+    #          (records with the wrong number of columns, or a Vector Type or
+    #          Source Sex outside its translation table, stop imageparse.py and
+    #          are not generated.)
+    # Returns: input file name (string)
+    # Assumes: nothing
+    # Effects: writes the input file and the translation tables
+    # Throws: IOError if a file cannot be written
+
+    organs = map(lambda i: 'organ %d' % (i), range(distinct))
+    tissues = map(lambda i: 'tissue %d' % (i), range(distinct))
+    stages = map(lambda i: 'stage %d' % (i), range(distinct))
+    strains = map(lambda i: 'strain %d' % (i), range(distinct))
+
+    # half of each pool is translated
+
+    tissueKeys = map(lambda i: (organs[i], tissues[i]), range(distinct))
+    tissueHits = tissueKeys[:distinct / 2 + 1]
+    tissueMisses = tissueKeys[distinct / 2 + 1:] or [('organ x', 'tissue x')]
+
+    ageKeys = map(lambda i: (stages[i], 'description %d' % (i)), range(distinct))
+    ageHits = ageKeys[:distinct / 2 + 1]
+    ageMisses = ageKeys[distinct / 2 + 1:] or [('stage x', 'description x')]
+
+    strainHits = strains[:distinct / 2 + 1]
+    strainMisses = strains[distinct / 2 + 1:] or ['strain x']
+
+    fp = open(os.path.join(dirName, 'imagetissue.trans'), 'w')
+    for organ, tissue in tissueHits:
+        fp.write(organ + TAB + tissue + TAB + 'MGI ' + tissue + CRT)
+    fp.close()
+
+    fp = open(os.path.join(dirName, 'imageage.trans'), 'w')
+    for stage, description in ageHits:
+        fp.write(stage + TAB + description + TAB + 'embryonic day %d.5' % (len(stage) % 19) + CRT)
+    fp.close()
+
+    fp = open(os.path.join(dirName, 'imagestrain.trans'), 'w')
+    for strain in strainHits:
+        fp.write(strain + TAB + 'MGI ' + strain + CRT)
+    fp.close()
+
+    fileName = os.path.join(dirName, inputFileNames['image'])
+    fp = open(fileName, 'w')
+
+    for i in range(records):
+
+        if rng.random() < malformedRate:
+            organism = 'Homo sapiens'
+        else:
+            organism = 'Mus musculus'
+
+        organ, tissue = pick(rng, hitRate, tissueHits, tissueMisses)
+        stage, description = pick(rng, hitRate, ageHits, ageMisses)
+
+        fp.write(string.join(['Bench Library %d' % (i), str(100000 + i), organism, organ, tissue,
+	    'DH10B', 'pSPORT1', rng.choice(['plasmid', 'phagemid']), 'SalI', 'NotI',
+	    'synthetic library %d' % (i), 'linker 3', 'linker 5', 'oligo-dT', '',
+	    rng.choice(imageSexes), stage, description, 'tag',
+	    pick(rng, hitRate, strainHits, strainMisses)], TAB) + CRT)
+
+    fp.close()
+
+    return fileName
+
+def generateNIA(
+    dirName,		# work directory (string)
+    records,		# number of records (integer)
+    hitRate,		# fraction of translated values (float)
+    malformedRate,	# fraction of malformed records (float)
+    distinct,		# distinct values per field (integer)
+    rng			# random.Random
+    ):
+    # Purpose: write a synthetic NIA file of multi-line library stanzas.
+    #          a malformed stanza is one niaparse.py reads but cannot fully
+    #          translate: it has no NIA Library ID line and an empty Strain.
+    #          (lines with more than one tab stop niaparse.py and are not generated.)
+    # Returns: input file name (string)
+    # Assumes: nothing
+    # Effects: writes the input file
+    # Throws: IOError if the file cannot be written
+
+    idMisses = map(lambda i: 'cDNAX%d' % (i), range(distinct))
+    strainMisses = map(lambda i: 'strain %d' % (i), range(distinct))
+
+    fileName = os.path.join(dirName, inputFileNames['nia'])
+    fp = open(fileName, 'w')
+
+    for i in range(records):
+
+        malformed = rng.random() < malformedRate
+
+        fp.write('Name' + TAB + 'Bench NIA Library %d' % (i) + CRT)
+        if not malformed:
+            fp.write('NIA Library ID' + TAB + pick(rng, hitRate, niaLibraryIDs, idMisses) + CRT)
+        fp.write('IAMGE Library ID' + TAB + str(100000 + i) + CRT)
+        fp.write('Organism' + TAB + 'Mus musculus' + CRT)
+        if malformed:
+            fp.write('Strain' + TAB + CRT)
+        else:
+            fp.write('Strain' + TAB + pick(rng, hitRate, niaStrains, strainMisses) + CRT)
+        fp.write('Sex' + TAB + 'Unknown' + CRT)
+        fp.write('Tissue' + TAB + 'tissue %d' % (rng.randrange(distinct)) + CRT)
+        fp.write('Stage' + TAB + 'stage %d' % (rng.randrange(distinct)) + CRT)
+        fp.write('Host' + TAB + 'DH10B' + CRT)
+        fp.write('Vector' + TAB + 'pSPORT1' + CRT)
+        fp.write('V_Type' + TAB + rng.choice(['plasmid', 'phagemid']) + CRT)
+        fp.write('RE_1' + TAB + 'SalI' + CRT)
+        fp.write('RE_2' + TAB + 'NotI' + CRT)
+        fp.write('Description (all one line)' + CRT)
+        fp.write('           synthetic library %d' % (i) + CRT)
+        fp.write(CRT)
+
+    fp.close()
+
+    return fileName
+
+def runParser(
+    parser,		# 'image' or 'nia'
+    inputFileName,	# input file name (string)
+    snapshotFileName	# vocabulary snapshot file name (string), or ''
+    ):
+    # Purpose: run a parser once, in the directory of its input file
+    # Returns: (elapsed seconds (float), stdout of the parser (string))
+    # Assumes: nothing
+    # Effects: runs the parser
+    # Throws: RuntimeError if the parser fails
+
+    args = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), parsers[parser]),
+	'-I', os.path.basename(inputFileName)]
+
+    if snapshotFileName != '':
+        args = args + ['-V', os.path.abspath(snapshotFileName)]
+
+    startTime = time.time()
+    p = subprocess.Popen(args, cwd = os.path.dirname(inputFileName), stdout = subprocess.PIPE)
+    output = p.communicate()[0]
+    elapsed = time.time() - startTime
+
+    if p.returncode != 0:
+        raise RuntimeError('%s exited with status %d' % (parsers[parser], p.returncode))
+
+    return elapsed, output
+
+def checksum(
+    fileName	# file name (string)
+    ):
+    # Purpose: compute the md5 of a file
+    # Returns: hex digest (string), or '-' if the file does not exist
+    # Assumes: nothing
+    # Effects: nothing
+    # Throws: nothing
+
+    if not os.path.exists(fileName):
+        return '-'
+
+    m = hashlib.md5()
+    fp = open(fileName, 'rb')
+    while 1:
+        data = fp.read(1 << 20)
+        if not data:
+            break
+        m.update(data)
+    fp.close()
+
+    return m.hexdigest()
+
+#
+# Main
+#
+
+try:
+    optlist, args = getopt.getopt(sys.argv[1:], 'P:n:t:m:k:s:r:d:V:')
+except:
+    showUsage()
+
+parser = ''
+records = 10000
+hitRate = 0.9
+malformedRate = 0.01
+distinct = 50
+seed = 1
+repeats = 3
+dirName = ''
+snapshotFileName = ''
+
+try:
+    for opt in optlist:
+        if opt[0] == '-P':
+            parser = opt[1]
+        elif opt[0] == '-n':
+            records = string.atoi(opt[1])
+        elif opt[0] == '-t':
+            hitRate = string.atof(opt[1])
+        elif opt[0] == '-m':
+            malformedRate = string.atof(opt[1])
+        elif opt[0] == '-k':
+            distinct = string.atoi(opt[1])
+        elif opt[0] == '-s':
+            seed = string.atoi(opt[1])
+        elif opt[0] == '-r':
+            repeats = string.atoi(opt[1])
+        elif opt[0] == '-d':
+            dirName = opt[1]
+        elif opt[0] == '-V':
+            snapshotFileName = opt[1]
+except ValueError:
+    showUsage()
+
+if not parsers.has_key(parser) or records < 1 or repeats < 1 or distinct < 1:
+    showUsage()
+
+if dirName == '':
+    dirName = tempfile.mkdtemp('.librarybench')
+elif not os.path.isdir(dirName):
+    os.makedirs(dirName)
+
+rng = random.Random(seed)
+
+if parser == 'image':
+    inputFileName = generateImage(dirName, records, hitRate, malformedRate, distinct, rng)
+else:
+    inputFileName = generateNIA(dirName, records, hitRate, malformedRate, distinct, rng)
+
+fp = open(inputFileName, 'r')
+inputLines = len(fp.readlines())
+fp.close()
+
+times = []
+
+for i in range(repeats):
+    try:
+        elapsed, parserOutput = runParser(parser, inputFileName, snapshotFileName)
+        times.append(elapsed)
+    except RuntimeError, message:
+        sys.stderr.write('%s\n' % (message))
+        sys.exit(1)
+
+best = min(times)
+if best > 0:
+    linesPerSecond = inputLines / best
+else:
+    linesPerSecond = 0.0
+
+# ru_maxrss of the children is the largest of any parser run (KB on Linux)
+peakMemory = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+sys.stdout.write(string.join(['parser', 'records', 'input lines', 'best seconds', 'lines/second',
+	'peak memory (KB)', 'output md5', 'error md5'], TAB) + CRT)
+sys.stdout.write(string.join([parser, str(records), str(inputLines), '%.3f' % (best),
+	'%.0f' % (linesPerSecond), str(peakMemory), checksum(inputFileName + '.lib'),
+	checksum(inputFileName + '.error')], TAB) + CRT)
+sys.stdout.write('work directory: %s\n' % (dirName))
+
+# the parser's own statistics (e.g. the translation cache of imageparse.py)
+sys.stderr.write(parserOutput)
+
+sys.exit(0)
@@ -0,0 +1,129 @@
+#!/usr/local/bin/python
+
+#
+# Program: librarydiff.py
+#
+# Purpose:
+#
+#	Batch change detection for libraryload.py.
+#
+#	The new and current values of a batch of existing libraries are
+#	held as aligned integer columns (one value per library, in the same
+#	order in every column); each column is compared as a whole and the
+#	result is one bitmask per library of the columns which have changed.
+#
+#	NumPy is used if it is installed, else the array module.
+#
+# Usage:
+#
+#	import librarydiff
+#	columns = librarydiff.Columns(3)
+#	columns.append([new values], [current values])
+#	...
+#	or, a column at a time:
+#	columns.setColumn(0, [new values], [current values])
+#	...
+#	masks = columns.diff([Not Specified values])
+#
+# Implementation:
+#
+#	Modules:
+#
+#	def changedColumns():	returns the column indexes set in a bitmask
+#
+
+import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#globals
+
+NULLVALUE = -1		# a NULL (None) current value
+NOVALUE = -2		# the Not Specified value of a column which has none
+
+if numpy is not None:
+    ENGINE = 'numpy'
+else:
+    ENGINE = 'array'
+
+class Columns:
+    # Purpose: the new and current values of a batch of rows,
+    #          as aligned integer columns
+
+    def __init__(self, count):
+        self.count = count
+        self.new = []
+        self.current = []
+        for i in range(count):
+            self.new.append(array.array('l'))
+            self.current.append(array.array('l'))
+        self.rows = 0
+
+    def append(self, newRow, currentRow):
+        # Purpose: add the new and current values of one row
+        #          (one integer per column)
+
+        for i in range(self.count):
+            self.new[i].append(newRow[i])
+            self.current[i].append(currentRow[i])
+        self.rows = self.rows + 1
+
+    def setColumn(self, i, newValues, currentValues):
+        # Purpose: set the new and current values of column i for every row
+        #          (one integer per row; every column must have the same rows)
+
+        self.new[i] = array.array('l', newValues)
+        self.current[i] = array.array('l', currentValues)
+        self.rows = len(newValues)
+
+    def diff(self, nsValues):
+        # Purpose: compare the new and current values of every row
+        #          a column has changed if its new value differs from its
+        #          current value and is not the column's Not Specified value
+        #          (nsValues[i], or NOVALUE)
+        # Returns: list of bitmasks, one per row; bit i is set if column i changed
+
+        if self.rows == 0:
+            return []
+
+        if numpy is not None:
+            new = numpy.array([numpy.frombuffer(c, dtype = c.typecode) for c in self.new])
+            current = numpy.array([numpy.frombuffer(c, dtype = c.typecode) for c in self.current])
+            ns = numpy.array(nsValues, dtype = new.dtype).reshape((self.count, 1))
+            changed = (new != current) & (new != ns)
+            weights = numpy.left_shift(1, numpy.arange(self.count, dtype = numpy.int64))
+            return [int(m) for m in numpy.dot(weights, changed.astype(numpy.int64))]
+
+        masks = [0] * self.rows
+        for i in range(self.count):
+            new = self.new[i]
+            current = self.current[i]
+            ns = nsValues[i]
+            bit = 1 << i
+            for row in range(self.rows):
+                if new[row] != current[row] and new[row] != ns:
+                    masks[row] = masks[row] | bit
+
+        return masks
+
+def changedColumns(
+    mask	# bitmask returned by Columns.diff()
+    ):
+    # Purpose: the column indexes set in a bitmask
+    # Returns: list of integers, in column order
+    # Assumes: nothing
+    # Effects: nothing
+    # Throws: nothing
+
+    columns = []
+    i = 0
+    while mask:
+        if mask & 1:
+            columns.append(i)
+        mask = mask >> 1
+        i = i + 1
+
+    return columns
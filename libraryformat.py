@@ -0,0 +1,331 @@
+#!/usr/local/bin/python
+
+#
+# Program: libraryformat.py
+#
+# Purpose:
+#
+#	Indexed intermediate format for parsed library files, an alternative
+#	to the tab-delimited (.lib) hand-off between the parsers and libraryload.py.
+#
+#	Each record is stored length-prefixed, and a footer index gives the
+#	offset of each record by Library Name, Logical DB and Library ID, so that
+#	a file can be re-read (or a subset of its libraries selected) without
+#	scanning and splitting every line.  Uncompressed files are read
+#	through mmap; only the pages of the records read are touched.
+#
+# Usage:
+#
+#	To convert a tab-delimited file to the indexed format, or back
+#	(the direction is determined by the input file):
+#
+#	libraryformat.py -I input file -O output file [-S selection file]
+#
+#	-S only the libraries named in the selection file are written
+#
+#	From libraryload.py:
+#
+#	import libraryformat
+#	if libraryformat.isIndexed(fileName):
+#	    entries = libraryformat.readNumberedLines(fileName, selection)
+#
+# Inputs/Outputs:
+#
+#	Indexed file:
+#		header:	MAGIC
+#		record:	4-byte length, then the 15 tab-delimited fields
+#			of libraryload.py's input format (no newline)
+#		...
+#		index:	per record: 8-byte offset and 4-byte length of the record,
+#			4-byte length, then Library Name TAB Logical DB TAB Library ID
+#		...
+#		footer:	8-byte offset of the index, MAGIC
+#
+#	(all integers are unsigned, big-endian)
+#
+#	Selection file:
+#		one Library Name or Library ID per line
+#
+# Exit Codes:
+#
+#       0 = successful
+#       1 = error
+#
+# Implementation:
+#
+#	Modules:
+#
+#	def showUsage():	prints usage of this program and exits
+#	def isIndexed():	returns true if a file is in the indexed format
+#	def mapFile():		returns the contents of an indexed file
+#	def readIndex():	reads the index of an indexed file
+#	def readSelection():	reads a selection file
+#	def isSelected():	returns true if a library is selected
+#	def readNumberedLines(): reads the (selected) records of an indexed file, with their record numbers
+#	def readLines():	reads the (selected) records of an indexed file as tab-delimited lines
+#	def writeFile():	writes tab-delimited lines as an indexed file
+#
+
+import sys
+import os
+import string
+import struct
+import mmap
+import libraryio
+
+#globals
+
+TAB = '\t'
+CRT = '\n'
+
+MAGIC = 'LIBIDX1\n'
+FOOTERSIZE = 8 + len(MAGIC)
+
+def showUsage():
+    # Purpose: displays correct usage of this program
+    # Returns: nothing
+    # Assumes: nothing
+    # Effects: exits with status of 1
+    # Throws: nothing
+
+    sys.stderr.write('usage: %s -I input file -O output file [-S selection file]\n' % sys.argv[0])
+    sys.exit(1)
+
+def isIndexed(
+    fileName	# file name (string)
+    ):
+    # Purpose: determine if a file is in the indexed format
+    # Returns: 1 if it is, else 0
+    # Assumes: nothing
+    # Effects: reads the first bytes of the file
+    # Throws: IOError if the file cannot be opened
+
+    fp = libraryio.openFile(fileName, 'r')
+    head = fp.read(len(MAGIC))
+    fp.close()
+
+    return head == MAGIC
+
+def mapFile(
+    fileName	# indexed file name (string)
+    ):
+    # Purpose: map an uncompressed indexed file into memory,
+    #          or read a compressed one
+    # Returns: mmap or string
+    # Assumes: nothing
+    # Effects: nothing
+    # Throws: IOError if the file cannot be read
+
+    if libraryio.sniffCompression(fileName) is None and os.path.getsize(fileName) > 0:
+        fp = open(fileName, 'rb')
+        data = mmap.mmap(fp.fileno(), 0, access = mmap.ACCESS_READ)
+        fp.close()
+        return data
+
+    fp = libraryio.openFile(fileName, 'r')
+    data = fp.read()
+    fp.close()
+
+    return data
+
+def readIndex(
+    data	# contents of an indexed file (mmap or string)
+    ):
+    # Purpose: read the footer index of an indexed file
+    # Returns: list of (offset, length, library name, logical DB, library ID), in file order
+    # Assumes: nothing
+    # Effects: nothing
+    # Throws: ValueError if the data is not a complete indexed file
+
+    size = len(data)
+
+    if size < len(MAGIC) + FOOTERSIZE or data[:len(MAGIC)] != MAGIC or data[size - len(MAGIC):] != MAGIC:
+        raise ValueError('Not an indexed library file')
+
+    i = struct.unpack('>Q', data[size - FOOTERSIZE:size - len(MAGIC)])[0]
+    end = size - FOOTERSIZE
+
+    index = []
+
+    while i < end:
+        offset, length, keyLength = struct.unpack('>QII', data[i:i + 16])
+        i = i + 16
+        name, logicalDB, libraryID = string.split(data[i:i + keyLength], TAB)
+        i = i + keyLength
+        index.append((offset, length, name, logicalDB, libraryID))
+
+    return index
+
+def readSelection(
+    fileName	# selection file name (string)
+    ):
+    # Purpose: read a selection file
+    # Returns: dictionary of selected library names and IDs
+    # Assumes: nothing
+    # Effects: nothing
+    # Throws: IOError if the file cannot be read
+
+    selection = {}
+
+    fp = libraryio.openFile(fileName, 'r')
+    for line in fp.readlines():
+        value = string.strip(line)
+        if len(value) > 0:
+            selection[value] = 1
+    fp.close()
+
+    return selection
+
+def isSelected(
+    selection,	# dictionary returned by readSelection(), or None for all
+    name,	# library name (string)
+    libraryID	# library ID (string)
+    ):
+    # Purpose: determine if a library is selected by its name or ID
+    # Returns: 1 if it is selected, else 0
+    # Assumes: nothing
+    # Effects: nothing
+    # Throws: nothing
+
+    if selection is None:
+        return 1
+
+    return selection.has_key(name) or (len(libraryID) > 0 and selection.has_key(libraryID))
+
+def readNumberedLines(
+    fileName,		# indexed file name (string)
+    selection = None	# dictionary returned by readSelection(), or None for all
+    ):
+    # Purpose: read the records of an indexed file, using the index to
+    #          read only the selected ones
+    # Returns: list of (record number, tab-delimited line (with newline)), in file order;
+    #          the first record is number 1, whether or not it is selected
+    # Assumes: nothing
+    # Effects: nothing
+    # Throws: IOError if the file cannot be read
+    #         ValueError if it is not a complete indexed file
+
+    data = mapFile(fileName)
+
+    entries = []
+    recordNum = 0
+    for offset, length, name, logicalDB, libraryID in readIndex(data):
+        recordNum = recordNum + 1
+        if isSelected(selection, name, libraryID):
+            entries.append((recordNum, data[offset:offset + length] + CRT))
+
+    if isinstance(data, mmap.mmap):
+        data.close()
+
+    return entries
+
+def readLines(
+    fileName,		# indexed file name (string)
+    selection = None	# dictionary returned by readSelection(), or None for all
+    ):
+    # Purpose: read the records of an indexed file, using the index to
+    #          read only the selected ones
+    # Returns: list of tab-delimited lines (with newlines), in file order
+    # Assumes: nothing
+    # Effects: nothing
+    # Throws: IOError if the file cannot be read
+    #         ValueError if it is not a complete indexed file
+
+    return map(lambda e: e[1], readNumberedLines(fileName, selection))
+
+def writeFile(
+    fileName,	# indexed file name (string)
+    lines	# tab-delimited lines
+    ):
+    # Purpose: write tab-delimited lines as an indexed file
+    # Returns: nothing
+    # Assumes: nothing
+    # Effects: writes the file
+    # Throws: IOError if the file cannot be written
+
+    fp = libraryio.openFile(fileName, 'w')
+    fp.write(MAGIC)
+
+    offset = len(MAGIC)
+    index = []
+
+    for line in lines:
+        if line[-1:] == CRT:
+            line = line[:-1]
+        tokens = string.split(line, TAB)
+        tokens = tokens + [''] * (3 - len(tokens))
+        fp.write(struct.pack('>I', len(line)))
+        fp.write(line)
+        index.append((offset + 4, len(line), string.join(tokens[:3], TAB)))
+        offset = offset + 4 + len(line)
+
+    for recordOffset, length, key in index:
+        fp.write(struct.pack('>QII', recordOffset, length, len(key)))
+        fp.write(key)
+
+    fp.write(struct.pack('>Q', offset))
+    fp.write(MAGIC)
+    fp.close()
+
+    return
+
+#
+# Main
+#
+
+if __name__ == '__main__':
+
+    import getopt
+
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], 'I:O:S:')
+    except:
+        showUsage()
+
+    inputFileName = ''
+    outputFileName = ''
+    selection = None
+
+    for opt in optlist:
+        if opt[0] == '-I':
+            inputFileName = opt[1]
+        elif opt[0] == '-O':
+            outputFileName = opt[1]
+        elif opt[0] == '-S':
+            try:
+                selection = readSelection(opt[1])
+            except IOError:
+                sys.stderr.write('Could not open file %s\n' % opt[1])
+                sys.exit(1)
+
+    if inputFileName == '' or outputFileName == '':
+        showUsage()
+
+    try:
+        indexed = isIndexed(inputFileName)
+    except IOError:
+        sys.stderr.write('Could not open file %s\n' % inputFileName)
+        sys.exit(1)
+
+    try:
+        if indexed:
+            lines = readLines(inputFileName, selection)
+            fp = libraryio.openFile(outputFileName, 'w')
+            for line in lines:
+                fp.write(line)
+            fp.close()
+        else:
+            fp = libraryio.openFile(inputFileName, 'r')
+            lines = []
+            for line in fp.readlines():
+                tokens = string.split(line[:-1], TAB)
+                tokens = tokens + [''] * (3 - len(tokens))
+                if isSelected(selection, tokens[0], tokens[2]):
+                    lines.append(line)
+            fp.close()
+            writeFile(outputFileName, lines)
+    except (IOError, ValueError), message:
+        sys.stderr.write('%s: %s\n' % (inputFileName, message))
+        sys.exit(1)
+
+    sys.exit(0)
@@ -0,0 +1,187 @@
+#!/usr/local/bin/python
+
+#
+# Program: libraryio.py
+#
+# Purpose:
+#
+#	File open helpers shared by imageparse.py, niaparse.py and libraryload.py.
+#
+#	Input files compressed with gzip, bzip2 or xz are detected
+#	(by file name suffix or by their leading magic bytes) and are
+#	stream-decompressed as they are read; nothing is written to disk.
+#
+#	Output files may optionally be written compressed.
+#
+# Usage:
+#
+#	import libraryio
+#	fp = libraryio.openFile(fileName, 'r')
+#	fp = libraryio.openFile(libraryio.outputName(fileName, 'gz'), 'w')
+#
+# Implementation:
+#
+#	Modules:
+#
+#	def compressionOf():	returns the compression type of a file name
+#	def sniffCompression():	returns the compression type of an existing file
+#	def stripCompression():	strips a compression suffix from a file name
+#	def outputName():	appends a compression suffix to a file name
+#	def openFile():		opens a (possibly compressed) file
+#
+
+import gzip
+import bz2
+import subprocess
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+#globals
+
+COMPRESSIONS = ['gz', 'bz2', 'xz']
+
+# leading bytes of each compressed format
+magicLookup = {'gz':'\x1f\x8b', 'bz2':'BZh', 'xz':'\xfd7zXZ\x00'}
+
+class PipeFile:
+    # Purpose: file-like wrapper around an external (de)compressor
+    #          used for xz when the lzma module is not available
+
+    def __init__(self, fileName, mode):
+        if mode[0] == 'r':
+            self.process = subprocess.Popen(['xz', '-dc', fileName], stdout = subprocess.PIPE)
+            self.fp = self.process.stdout
+            self.target = None
+        else:
+            self.target = open(fileName, 'wb')
+            self.process = subprocess.Popen(['xz', '-c'], stdin = subprocess.PIPE, stdout = self.target)
+            self.fp = self.process.stdin
+
+    def __iter__(self):
+        return iter(self.fp)
+
+    def read(self, *args):
+        return self.fp.read(*args)
+
+    def readline(self, *args):
+        return self.fp.readline(*args)
+
+    def readlines(self, *args):
+        return self.fp.readlines(*args)
+
+    def write(self, s):
+        return self.fp.write(s)
+
+    def flush(self):
+        return self.fp.flush()
+
+    def close(self):
+        self.fp.close()
+        status = self.process.wait()
+        if self.target is not None:
+            self.target.close()
+        if status != 0:
+            raise IOError('xz exited with status %s' % (status))
+
+def compressionOf(
+    fileName	# file name (string)
+    ):
+    # Purpose: determine the compression type from the file name suffix
+    # Returns: 'gz', 'bz2', 'xz' or None
+    # Assumes: nothing
+    # Effects: nothing
+    # Throws: nothing
+
+    for c in COMPRESSIONS:
+        if fileName[-len(c) - 1:] == '.' + c:
+            return c
+
+    return None
+
+def sniffCompression(
+    fileName	# file name (string)
+    ):
+    # Purpose: determine the compression type of an existing file
+    #          from its suffix, or failing that, its leading bytes
+    # Returns: 'gz', 'bz2', 'xz' or None
+    # Assumes: nothing
+    # Effects: reads the first bytes of the file
+    # Throws: IOError if the file cannot be opened
+
+    compression = compressionOf(fileName)
+    if compression is not None:
+        return compression
+
+    fp = open(fileName, 'rb')
+    head = fp.read(6)
+    fp.close()
+
+    for c in COMPRESSIONS:
+        if head[:len(magicLookup[c])] == magicLookup[c]:
+            return c
+
+    return None
+
+def stripCompression(
+    fileName	# file name (string)
+    ):
+    # Purpose: remove any compression suffix from the file name
+    # Returns: file name (string)
+    # Assumes: nothing
+    # Effects: nothing
+    # Throws: nothing
+
+    compression = compressionOf(fileName)
+    if compression is not None:
+        return fileName[:-len(compression) - 1]
+
+    return fileName
+
+def outputName(
+    fileName,		# file name (string)
+    compression = None	# 'gz', 'bz2', 'xz' or None
+    ):
+    # Purpose: add the compression suffix to an output file name
+    # Returns: file name (string)
+    # Assumes: nothing
+    # Effects: nothing
+    # Throws: ValueError if the compression type is unknown
+
+    if not compression:
+        return fileName
+
+    if compression not in COMPRESSIONS:
+        raise ValueError('Invalid Compression: %s' % (compression))
+
+    return fileName + '.' + compression
+
+def openFile(
+    fileName,		# file name (string)
+    mode = 'r'		# 'r' or 'w'
+    ):
+    # Purpose: open a file, decompressing on read or compressing on write
+    #          as determined by the file name (and on read, its contents)
+    # Returns: file-like object
+    # Assumes: nothing
+    # Effects: opens the file
+    # Throws: IOError if the file cannot be opened
+
+    if mode[0] == 'r':
+        compression = sniffCompression(fileName)
+    else:
+        compression = compressionOf(fileName)
+
+    if compression == 'gz':
+        return gzip.open(fileName, mode[0] + 'b')
+    elif compression == 'bz2':
+        return bz2.BZ2File(fileName, mode[0])
+    elif compression == 'xz':
+        if lzma is not None:
+            return lzma.open(fileName, mode[0] + 'b')
+        return PipeFile(fileName, mode)
+
+    return open(fileName, mode)
+
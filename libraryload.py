@@ -26,9 +26,84 @@
 #		preview - perform all record verifications but do not load the data or
 #		          make any changes to the database.  used for testing or to preview
 #			  the load.
+#			  if LIBRARYPLANFILE is set, the changes are written to a plan file.
+#
+#		apply - execute the changes of a plan file (LIBRARYPLANFILE) written by
+#			a preview run, without re-verifying the input.  the plan is refused
+#			if the libraries it touches (their PRB_Source rows, Library IDs and
+#			clone collection members), or the clone collections it adds to,
+#			have changed since the preview.
+#			LIBRARYINPUTFILE is not used; the diagnostics and error files are
+#			named after the plan file.
+#
+#	daemon (full or preview mode): if LIBRARYWATCHDIR is set, the input directory
+#	is polled and each file is loaded once it has stopped growing, keeping the
+#	connection and lookup caches between files; the file is then moved to the
+#	done/ or failed/ subdirectory.  runs until SIGTERM (or SIGINT), after the
+#	file in progress.
 #
 # Envvars:
 #
+#	LIBRARYINPUTFILE	input file, directory of input files, or glob pattern of input files
+#				(not used by the daemon);
+#				each file may be gzip, bzip2 or xz compressed.
+#				all files are loaded with one connection and shared lookup caches,
+#				each with its own diagnostics and error files; a file which fails
+#				is reported and the remaining files are still loaded.
+#				a file in the indexed format (see libraryformat.py) is read through its index.
+#	LIBRARYSELECT		optional; selection file (one Library Name or Library ID per line);
+#				only the selected libraries of the input are loaded
+#	LIBRARYCOMPRESS		optional; gz, bz2 or xz to write compressed
+#				diagnostics and error files
+#	LIBRARYVOCABCACHE	optional; vocabulary cache file shared by
+#				concurrent loads (see libraryloaddriver.py)
+#	LIBRARYBATCHSIZE	optional; number of libraries written per batch (default 500)
+#	LIBRARYINLISTSIZE	optional; number of terms resolved per query (default 1000)
+#	LIBRARYCOMMITSIZE	optional; commit every N libraries, and at the end of each batch,
+#				each library in its own savepoint (default 0 = autocommit each statement)
+#	LIBRARYCOMMITMIN	optional; with LIBRARYCOMMITMAX, the commit size is adjusted
+#	LIBRARYCOMMITMAX	between these bounds from the time each transaction takes
+#	LIBRARYCOMMITTARGET	optional; target seconds per transaction (default 2)
+#	LIBRARYSHARDS		optional; load with N worker processes (default 1)
+#	LIBRARYPLANFILE		optional; plan file written by preview mode, read by apply mode
+#	LIBRARYDBTRACE		optional; record every database call and its result to this trace file
+#	LIBRARYDBREPLAY		optional; replay the database calls of this trace file; no database is used
+#	LIBRARYQUERYBUDGET	optional; fail if the database calls per input row exceed this number
+#	LIBRARYMETRICSFILE	optional; metrics file (node_exporter textfile format) written at exit
+#	LIBRARYSTATUSFILE	optional; status file rewritten while loading: current phase and line,
+#				rows per second, estimated time remaining and counters
+#	LIBRARYSTATUSINTERVAL	optional; seconds between status file updates (default 10)
+#	LIBRARYWATCHDIR		optional; run as a daemon, loading the files which arrive in this directory
+#	LIBRARYWATCHINTERVAL	optional; seconds between polls of LIBRARYWATCHDIR (default 30)
+#	LIBRARYCACHEINTERVAL	optional; seconds after which the daemon empties its lookup caches
+#				(default 3600; 0 = never)
+#	LIBRARYSTATSTHRESHOLD	optional; fraction (0-1) of the rows of PRB_Source, ACC_Accession or
+#				MGI_SetMember which, if changed by the run, has the statistics of
+#				that table updated at the end of the run (default 0 = never)
+#	LIBRARYPROVIDER		optional; provider label of the metrics (default: name of CONFIGFILE)
+#	LIBRARYDUPLICATES	optional; how repeated library names/IDs are coalesced:
+#				last (default), first, or reject (load none of them)
+#	LIBRARYFIELDMASK	optional; comma-separated parts of each library to load (default: all):
+#				attributes (add libraries; update PRB_Source columns),
+#				accessions (update Library IDs), collections (Clone Collections).
+#				the verification, queries and sql of the other parts are skipped;
+#				without attributes, libraries not already in the database are not added
+#	LIBRARYSCANTOLERANCE	optional; number of malformed input lines tolerated (default 0);
+#				malformed lines are reported and not loaded.  if there are more,
+#				the file is not loaded at all (see scanInput())
+#	LIBRARYCURATORPOLICY	optional; how existing libraries edited by a curator are handled:
+#				accessions (default; update only their Library ID and Clone Collections),
+#				skip (leave them untouched), or none (update them like any other library)
+#
+#	set by the coordinator for each worker process of a sharded load:
+#
+#	LIBRARYSHARDINDEX	shard loaded by this worker (0..N-1)
+#	LIBRARYSOURCEKEY	first _Source_key reserved for this worker
+#	LIBRARYMEMBERKEY	first _SetMember_key reserved for this worker
+#	LIBRARYOUTPUTNAME	base name of the diagnostics and error files of the input file
+#	LIBRARYSEQNUMS		first MGI_SetMember.sequenceNum reserved for this worker
+#				in each clone collection (_Set_key:sequenceNum,...)
+#
 # Input(s):
 #
 #	A tab-delimited file in the format:
@@ -52,6 +127,10 @@
 #
 #	Diagnostics file of all input parameters and SQL commands
 #	Error file
+#	Status file (if LIBRARYSTATUSFILE is set)
+#	On SIGUSR1, the current status and all statistics are written to stderr
+#	Metrics file (if LIBRARYMETRICSFILE is set): row counts, database calls and
+#	phase timings of each input file, labeled by provider and input file
 #
 # Exit Codes:
 #
@@ -69,10 +148,59 @@
 #	def showUsage():	prints usage of this program and exits
 #	def exit():		prints message to stderr and exists
 #	def init():		processes inputs; initializes globals
+#	def openFiles():	opens an input file and its diagnostics/error files
+#	def closeFiles():	closes an input file and its diagnostics/error files
+#	def readInput():	reads the (selected) lines of the current input file, with their line numbers
 #	def verifyMode():	verifies processing mode
+#	def loadVocabCache():	reads the shared vocabulary cache
+#	def saveVocabCache():	merges this run's lookups into the shared vocabulary cache
+#	def verifyTerm():	verifies a vocabulary term, using the vocabulary cache
+#	def noteInvalid():	records an occurrence of an invalid value
+#	def reportInvalid():	reports each distinct invalid value once
+#	def sqlList():		formats values as a SQL IN-list
+#	def preResolve():	resolves the distinct vocabulary terms and ages of the input in bulk
+#	def verifyAge():	verifies an age, using the age cache
+#	def shardOf():		returns the shard of an input line
+#	def runShards():	runs a sharded load; coordinates the worker processes
+#	def scanInput():	checks the structure of every input line, without database access
+#	def coalesceLines():	coalesces repeated libraries in the input
+#	def loadFile():		loads one input file; reports it if it fails
 #	def processFile():	processes file; main processing loop
-#	def addLibrary():	creates bcp records for new library
-#	def updateLibrary():	updates existing library
+#	def verifyRecord():	verifies the attributes of a library record
+#	def findRepeat():	finds a library repeated within a batch
+#	def processBatch():	adds/updates a batch of library records
+#	def addLibraries():	creates sql for new libraries
+#	def updateLibraries():	reads the current values of a batch of existing libraries
+#	def diffLibraries():	detects the changed columns of a batch of existing libraries
+#	def updateLibrary():	creates sql to update an existing library
+#	def addCloneCollections(): creates sql for the clone collections of a batch of libraries
+#	def verifySet():	verifies a clone collection, using the set cache
+#	def writeRecords():	executes the sql of a batch of libraries
+#	def planGuard():	returns the staleness guard of a plan (keys, row counts and checksums)
+#	def writePlan():	writes the changes of a batch of libraries to the plan file
+#	def finishPlan():	writes the staleness guard at the end of the plan file
+#	def applyPlan():	executes a plan file
+#	def commitTransaction(): commits the open transaction
+#	def adjustCommitSize():	adjusts the commit size from the time of the last transaction
+#	def reportCommitSizes(): reports the commit sizes used
+#	def checkQueryBudget():	reports database calls per input row; checks the query budget
+#	def executeChange():	executes a statement; returns the table and rows it changed
+#	def countTableChange():	counts the rows changed by a statement, by table
+#	def refreshStatistics(): updates the statistics of each table changed beyond LIBRARYSTATSTHRESHOLD
+#	def countMetric():	adds to a metric of the current input file
+#	def timePhase():	adds the time of a phase to the metrics of the current input file
+#	def recordAction():	returns the action taken for a library (add, update, unchanged)
+#	def countWritten():	counts the action and clone collection members of a written library
+#	def mergeShardMetrics(): adds the metrics of a shard worker to this process's metrics
+#	def writeMetrics():	writes the metrics file
+#	def startPhase():	records the start of a phase; updates the status file
+#	def statusLines():	returns the current status
+#	def writeStatus():	writes the status file
+#	def dumpStats():	writes the status and all statistics to stderr (SIGUSR1)
+#	def stopWatching():	stops the daemon after the file in progress (SIGTERM, SIGINT)
+#	def clearCaches():	empties the lookup caches
+#	def watchFiles():	daemon: polls LIBRARYWATCHDIR and loads each file which arrives
+#	def loadWatchedFile():	daemon: loads one file; moves it to done/ or failed/
 #
 #	Tools Used:
 #
@@ -80,7 +208,20 @@
 #
 #	Verify Mode; if mode = preview:  set DEBUG to True, else DEBUG is False.
 #
-#	For each line in the input file:
+#	Scan the structure of every input line (field count, encoding, line ending,
+#	empty required fields) and report every malformed line; unless
+#	LIBRARYSCANTOLERANCE allows them, malformed lines stop the load
+#	before any database work.
+#
+#	Coalesce input lines which repeat a Library Name or Library ID into one
+#	line per library (see LIBRARYDUPLICATES); report the duplicates.
+#
+#	Resolve the distinct vocabulary terms (References, Users, Logical DBs,
+#	Segment Types, Vector Types, Strains, Tissues, Genders, Cell Lines;
+#	one IN-list query per field and LIBRARYINLISTSIZE terms) not already
+#	in the vocabulary cache, and Ages (one parse each) used in the input file.
+#
+#	For each line in the input file, create a LibraryRecord:
 #
 #	  . Verify the Segment Type
 #
@@ -102,35 +243,83 @@
 #
 #	  . Verify the Reference (J:)
 #
-#	  . If any verification fails, report the error and skip the record.
+#	  . If any verification fails, skip the record.  Each distinct invalid value
+#	    is looked up once and reported once, with its number of occurrences.
+#
+#	For each batch of verified records:
 #
 #	  . If the Library cannot be found in the database, create and execute
 #	    insert statements for PRB_Source, ACC_Accession objects.
 #
 #	  . If the Library can be found in the database, update any attribute which
-#	    has not been modified by a curator.  Update the Library ID if it has been changed.
+#	    has changed (compared for the whole batch at once; see librarydiff.py), unless the Library has been modified by a curator
+#	    (PRB_Source.isCuratorEdited; see LIBRARYCURATORPOLICY).
+#	    Update the Library ID if it has been changed.
 #
 #	  . Process the Clone Collections
 #	    - delete existing 
 #
+#	If LIBRARYSTATSTHRESHOLD is set, update the statistics of each table
+#	whose changed rows exceed that fraction of the table.
+#
 
 import sys
 import os
 import string
+import operator
+import fcntl
+import cPickle
+import zlib
+import subprocess
+import glob
+import signal
+import re
+import time
+import hashlib
+import dbreplay
+import librarydiff
+
+# replay mode: serve every database call (including those of loadlib and sourceloadlib)
+# from a trace file recorded by an earlier run; see dbreplay.py
+if os.environ.get('LIBRARYDBREPLAY'):
+    sys.modules['db'] = dbreplay
+
 import db
 import mgi_utils
 import loadlib
 import sourceloadlib
+import libraryio
+import libraryformat
 
 #globals
 
 user = os.environ['MGD_DBUSER']
 passwordFileName = os.environ['MGD_DBPASSWORDFILE']
 mode = os.environ['LIBRARYMODE']
-inputFileName = os.environ['LIBRARYINPUTFILE']
+inputFileSpec = os.environ.get('LIBRARYINPUTFILE', '')
+compression = os.environ.get('LIBRARYCOMPRESS')
+vocabCacheFileName = os.environ.get('LIBRARYVOCABCACHE')
+dbTraceFileName = os.environ.get('LIBRARYDBTRACE')
+dbReplayFileName = os.environ.get('LIBRARYDBREPLAY')
+queryBudget = os.environ.get('LIBRARYQUERYBUDGET')
+selectFileName = os.environ.get('LIBRARYSELECT')
+selection = None	# selected library names and IDs (see libraryformat.py), or None for all
+rowsRead = 0		# input rows read by this process
+planFileName = os.environ.get('LIBRARYPLANFILE')
+metricsFileName = os.environ.get('LIBRARYMETRICSFILE')
+statusFileName = os.environ.get('LIBRARYSTATUSFILE')
+statusInterval = float(os.environ.get('LIBRARYSTATUSINTERVAL', '10'))
+watchDirName = os.environ.get('LIBRARYWATCHDIR')
+watchInterval = float(os.environ.get('LIBRARYWATCHINTERVAL', '30'))
+cacheInterval = float(os.environ.get('LIBRARYCACHEINTERVAL', '3600'))
+stopping = 0		# true once the daemon has been asked to stop
+statsThreshold = float(os.environ.get('LIBRARYSTATSTHRESHOLD', '0'))
+tableChanges = {}	# table -> rows changed by this run
+provider = os.environ.get('LIBRARYPROVIDER', os.path.basename(os.environ.get('CONFIGFILE', '')))
 
 DEBUG = 0		# set DEBUG to false unless preview mode is selected
 TAB = '\t'
+CRT = '\n'
 BCPDELIM = TAB
 REFERENCE = 'Reference'	# ACC_MGIType.name for References
 MGITYPEKEY = 5		# ACC_MGIType._MGIType_key for libraries
@@ -138,19 +327,108 @@ MGITYPE = 'Source'	# ACC_MGIType.name for Sources
 NS = 'Not Specified'
 isCuratorEdited = 0
 
+inputFileNames = []	# input files of this run
+inputFileName = ''	# current input file
+outputNames = {}	# input file -> base name of its diagnostics and error files (see init())
+loadingFileName = None	# input file being loaded by loadFile()
+filesProcessed = 0
+filesFailed = 0		# input files which could not be loaded
+
+# metrics of each input file (see writeMetrics())
+runStart = time.time()		# start time of this run
+fileStart = 0.0			# time the current input file was opened
+fileSqlCount = 0		# database calls made before the current input file was opened
+fileMetrics = {}		# input file name -> {metric name -> value}
+filePhases = {}			# input file name -> {phase -> seconds}
+
+# metric name, description
+metricsCounters = [('rows_read', 'Input rows read'),
+    ('added', 'Libraries added'),
+    ('updated', 'Libraries updated'),
+    ('unchanged', 'Libraries verified and unchanged'),
+    ('errored', 'Libraries not loaded because of errors'),
+    ('set_members', 'Clone collection members written'),
+    ('malformed', 'Malformed input lines'),
+    ('curator_edited', 'Curator-edited libraries whose attributes were not updated'),
+    ('db_calls', 'Database calls'),
+    ('seconds', 'Wall time')]
+
+# progress of the current input file (see writeStatus())
+currentPhase = 'init'	# phase in progress
+linesDone = 0		# lines processed in the current phase
+phaseStart = 0.0	# time the current phase began (the rate of its lines is measured from it)
+linesTotal = 0		# lines to process in the current phase
+lastStatus = 0.0	# time the status file was last written
+
+# action of a library (see recordAction()) -> metric name
+actionMetrics = {'add':'added', 'update':'updated', 'unchanged':'unchanged'}
+
 inputFile = ''		# file descriptor
 diagFile = ''		# file descriptor
 errorFile = ''		# file descriptor
+planFile = None		# file descriptor
+planSourceKeys = {}	# _Source_key of each library written to the plan file
+planSetKeys = {}	# _Set_key of each clone collection added to in the plan file
 
 diagFileName = ''	# file name
 errorFileName = ''	# file name
 
+class FileError(Exception):
+    # Purpose: raised by exit() in place of exiting when an input file
+    #          fails to load (see loadFile())
+    pass
+
 libraryTable = 'PRB_Source'
 setTable = 'MGI_Set'
 memberTable = 'MGI_SetMember'
 
 loaddate = loadlib.loaddate
 
+# verification function for each vocabulary field
+verifyLookup = {'Logical DB':loadlib.verifyLogicalDB,
+    'Segment Type':sourceloadlib.verifySegmentType,
+    'Vector Type':sourceloadlib.verifyVectorType,
+    'Strain':sourceloadlib.verifyStrain,
+    'Tissue':sourceloadlib.verifyTissue,
+    'Gender':sourceloadlib.verifyGender,
+    'Cell Line':sourceloadlib.verifyCellLine,
+    'Reference':loadlib.verifyReference,
+    'User':loadlib.verifyUser}
+
+# (field, value) -> key of each successfully verified vocabulary term
+vocabCache = {}
+
+# age -> (ageMin, ageMax) of each successfully verified age
+ageCache = {}
+
+# (field, value) of each value which failed verification
+invalidCache = {}
+
+# (field, value) -> [occurrences, first MAXINVALIDLINES line numbers]
+invalidValues = {}
+MAXINVALIDLINES = 5
+
+# maximum number of values in one IN-list
+MAXINLIST = int(os.environ.get('LIBRARYINLISTSIZE', '1000'))
+
+# field, input column, query resolving an IN-list of values to 'value', 'objectKey'
+preResolveQueries = [
+    ('Reference', 11, 'select value = accID, objectKey = _Object_key from ACC_Accession ' + \
+	'where _MGIType_key = 1 and _LogicalDB_key = 1 and prefixPart = "J:" and accID in (%s)'),
+    ('User', 14, 'select value = login, objectKey = _User_key from MGI_User where login in (%s)'),
+    ('Logical DB', 1, 'select value = name, objectKey = _LogicalDB_key from ACC_LogicalDB where name in (%s)'),
+    ('Segment Type', 3, 'select value = t.term, objectKey = t._Term_key from VOC_Term t, VOC_Vocab v ' + \
+	'where v.name = "Segment Type" and v._Vocab_key = t._Vocab_key and t.term in (%s)'),
+    ('Vector Type', 4, 'select value = t.term, objectKey = t._Term_key from VOC_Term t, VOC_Vocab v ' + \
+	'where v.name = "Segment Vector Type" and v._Vocab_key = t._Vocab_key and t.term in (%s)'),
+    ('Strain', 6, 'select value = strain, objectKey = _Strain_key from PRB_Strain where strain in (%s)'),
+    ('Tissue', 7, 'select value = tissue, objectKey = _Tissue_key from PRB_Tissue where tissue in (%s)'),
+    ('Gender', 9, 'select value = t.term, objectKey = t._Term_key from VOC_Term t, VOC_Vocab v ' + \
+	'where v.name = "Gender" and v._Vocab_key = t._Vocab_key and t.term in (%s)'),
+    ('Cell Line', 10, 'select value = t.term, objectKey = t._Term_key from VOC_Term t, VOC_Vocab v ' + \
+	'where v.name = "Cell Line" and v._Vocab_key = t._Vocab_key and t.term in (%s)'),
+    ]
+
 # Library Column Names (PRB_Source)
 libColNames = ['name',
     '_SegmentType_key',
@@ -163,25 +441,20 @@ libColNames = ['name',
     '_CellLine_key',
     'age']
 
-# Library record attributes
+# PRB_Source column, LibraryRecord attribute, Not Specified global (or None), string column?
+libColumns = [('name', 'libraryName', None, 1),
+    ('_SegmentType_key', 'segmentTypeKey', None, 0),
+    ('_Vector_key', 'vectorTypeKey', None, 0),
+    ('_Refs_key', 'referenceKey', None, 0),
+    ('_Organism_key', 'organismKey', None, 0),
+    ('_Strain_key', 'strainKey', 'strainNS', 0),
+    ('_Tissue_key', 'tissueKey', 'tissueNS', 0),
+    ('_Gender_key', 'genderKey', 'genderNS', 0),
+    ('_CellLine_key', 'cellLineKey', 'cellLineNS', 0),
+    ('age', 'age', 'ageNS', 1)]
 
-libraryKey = ''
 description = 'NULL'
-libraryName = ''
-libraryID = ''
-logicalDBKey = ''
-segmentTypeKey = ''
-vectorTypeKey = ''
 organismKey = '1'
-referenceKey = ''
-strainKey = ''
-tissueKey = ''
-genderKey = ''
-cellLineKey = ''
-age = ''
-ageMin = ''
-ageMax = ''
-createdByKey = ''
 
 strainNS = ''
 tissueNS = ''
@@ -189,6 +462,111 @@ genderNS = ''
 cellLineNS = ''
 ageNS = ''
 
+batchSize = int(os.environ.get('LIBRARYBATCHSIZE', '500'))
+commitSize = int(os.environ.get('LIBRARYCOMMITSIZE', '0'))
+SAVEPOINT = 'library'	# savepoint name of the library being written
+uncommitted = 0		# libraries written in the open transaction
+inTransaction = 0	# true if a transaction is open
+transactionStart = 0.0	# time the open transaction began
+commitMin = int(os.environ.get('LIBRARYCOMMITMIN', '0'))
+commitMax = int(os.environ.get('LIBRARYCOMMITMAX', '0'))
+commitTarget = float(os.environ.get('LIBRARYCOMMITTARGET', '2'))
+commitSizes = {}	# commit size -> number of transactions committed with it
+nextLibraryKey = 0	# next available _Source_key
+nextMemberKey = 0	# next available _SetMember_key
+nextSeqNums = {}	# _Set_key -> next available sequenceNum
+
+duplicatePolicy = os.environ.get('LIBRARYDUPLICATES', 'last')
+scanTolerance = int(os.environ.get('LIBRARYSCANTOLERANCE', '0'))
+
+# fields (0-based) which may not be empty: Library Name, Created By
+requiredFields = [0, 14]
+# and when attributes are loaded (see fieldMask): Segment Type, Vector Type,
+# Strain, Tissue, Age, Gender, J#
+# (Organism is not loaded, and Cell Line is often empty, e.g. in niaparse.py
+# output, so both are left to verification)
+requiredAttributeFields = [3, 4, 6, 7, 8, 9, 11]
+
+# parts of each library loaded (LIBRARYFIELDMASK)
+MASKPARTS = ['attributes', 'accessions', 'collections']
+fieldMask = {}
+for part in string.split(os.environ.get('LIBRARYFIELDMASK', string.join(MASKPARTS, ',')), ','):
+    fieldMask[string.strip(part)] = 1
+
+# vocabularies verified only when attributes are loaded
+attributeVocabularies = ['Segment Type', 'Vector Type', 'Strain', 'Tissue', 'Gender', 'Cell Line', 'Reference']
+curatorPolicy = os.environ.get('LIBRARYCURATORPOLICY', 'accessions')
+
+shardCount = int(os.environ.get('LIBRARYSHARDS', '1'))
+shardIndex = os.environ.get('LIBRARYSHARDINDEX')
+if shardIndex is not None:
+    shardIndex = int(shardIndex)
+
+# MGI_Set.name -> _Set_key (0 if invalid)
+setCache = {}
+
+class LibraryRecord(object):
+    # Purpose: one input library: its input fields, its resolved keys
+    #          and the sql created to load it
+    #
+    # __slots__ keeps the per-record cost small and predictable
+    # so that large batches of records can be held in memory
+
+    # input fields, in input file order
+    inputFields = ('libraryName',
+	'logicalDB',
+	'libraryID',
+	'segmentType',
+	'vectorType',
+	'organism',
+	'strain',
+	'tissue',
+	'age',
+	'gender',
+	'cellLine',
+	'jnum',
+	'note',
+	'cloneCollections',
+	'createdBy')
+
+    # resolved keys
+    keyFields = ('libraryKey',
+	'logicalDBKey',
+	'segmentTypeKey',
+	'vectorTypeKey',
+	'organismKey',
+	'referenceKey',
+	'strainKey',
+	'tissueKey',
+	'genderKey',
+	'cellLineKey',
+	'ageMin',
+	'ageMax',
+	'createdByKey')
+
+    # isNew: true if the library is added
+    # changes: PRB_Source columns updated
+    # setKeys: clone collections (_Set_key) the library is added to
+    # curatorEdited: true if the existing library has been modified by a curator
+    # cmds: sql to load the library
+    __slots__ = ('lineNum', 'isNew', 'changes', 'setKeys', 'curatorEdited', 'cmds') + inputFields + keyFields
+
+    def __init__(self, lineNum, tokens = None):
+        self.lineNum = lineNum
+        self.isNew = 0
+        self.changes = []
+        self.setKeys = []
+        self.curatorEdited = 0
+        self.cmds = []
+        for i in range(len(self.inputFields)):
+            if tokens is None:
+                setattr(self, self.inputFields[i], '')
+            else:
+                setattr(self, self.inputFields[i], tokens[i])
+        for f in self.keyFields:
+            setattr(self, f, 0)
+        self.organismKey = organismKey
+
 def exit(
     status,          # numeric exit status (integer)
     message = None   # exit message (string)
@@ -200,18 +578,44 @@ def exit(
     # Effects: nothing
     # Throws: nothing
 
+    global currentPhase
+
+    # a file which fails does not stop the run (see loadFile())
+
+    if loadingFileName is not None and status != 0:
+        raise FileError(message)
+
     if message is not None:
         sys.stderr.write('\n' + str(message) + '\n')
 
+    if status == 0:
+        currentPhase = 'done'
+    else:
+        currentPhase = 'failed'
+
     try:
-        inputFile.close()
-        diagFile.write('\n\nEnd Date/Time: %s\n' % (mgi_utils.date()))
-        errorFile.write('\n\nEnd Date/Time: %s\n' % (mgi_utils.date()))
-        diagFile.close()
-        errorFile.close()
+        writeStatus(1)
+    except:
+        pass
+
+    try:
+        saveVocabCache()
+    except:
+        pass
+
+    try:
+        if planFile is not None:
+            planFile.close()
     except:
         pass
 
+    closeFiles()
+
+    try:
+        writeMetrics(status)
+    except:
+        sys.stderr.write('Could not write file %s\n' % metricsFileName)
+
     db.useOneConnection(0)
     sys.exit(status)
 
@@ -223,29 +627,144 @@ def init():
     #          exits if files cannot be opened
     # Throws: nothing
 
-    global inputFile, diagFile, errorFile, errorFileName, diagFileName
+    global inputFileNames, planFile, selection
+
+    # a signal must not interrupt a database call in progress (EINTR)
+    signal.signal(signal.SIGUSR1, dumpStats)
+    signal.siginterrupt(signal.SIGUSR1, False)
+
+    if dbReplayFileName:
+        if shardCount > 1:
+            exit(1, 'LIBRARYDBREPLAY cannot be used with LIBRARYSHARDS\n')
+        try:
+            dbreplay.replay(dbReplayFileName)
+        except IOError:
+            exit(1, 'Could not open file %s\n' % dbReplayFileName)
+    else:
+        traceFileName = dbTraceFileName
+        if traceFileName and shardIndex is not None:
+            traceFileName = traceFileName + '.shard%d' % (shardIndex)
+        try:
+            dbreplay.wrap(db, traceFileName)
+        except IOError:
+            exit(1, 'Could not open file %s\n' % traceFileName)
  
     db.useOneConnection(1)
     db.set_sqlUser(user)
     db.set_sqlPasswordFromFile(passwordFileName)
- 
+
+    # the daemon finds its input files as they arrive
+
+    if watchDirName and shardIndex is None:
+        if not os.path.isdir(watchDirName):
+            exit(1, 'Could not open directory %s\n' % watchDirName)
+        for d in ['done', 'failed']:
+            if not os.path.isdir(os.path.join(watchDirName, d)):
+                os.mkdir(os.path.join(watchDirName, d))
+        for sig in [signal.SIGTERM, signal.SIGINT]:
+            signal.signal(sig, stopWatching)
+            signal.siginterrupt(sig, False)
+        return
+
+    # LIBRARYINPUTFILE may name one file, a directory of files, or a glob pattern;
+    # apply mode reads only the plan file, and its diagnostics and error files
+    # are named after it
+
+    if mode == 'apply' and planFileName:
+        inputFileNames = [planFileName]
+    elif os.path.isdir(inputFileSpec):
+        inputFileNames = map(lambda f: os.path.join(inputFileSpec, f), \
+	    filter(lambda f: f[0] != '.', os.listdir(inputFileSpec)))
+        inputFileNames = filter(os.path.isfile, inputFileNames)
+    elif glob.has_magic(inputFileSpec):
+        inputFileNames = glob.glob(inputFileSpec)
+    else:
+        inputFileNames = [inputFileSpec]
+
+    inputFileNames.sort()
+
+    if len(inputFileNames) == 0:
+        exit(1, 'No input files: %s\n' % inputFileSpec)
+
+    # input files with the same name (in different directories) get their
+    # path in the names of their diagnostics and error files, e.g. a_image.lib;
+    # a shard worker uses the name of its coordinator
+
+    sameName = {}	# name -> input files
+    for f in inputFileNames:
+        name = os.path.basename(libraryio.stripCompression(f))
+        sameName[name] = sameName.get(name, []) + [f]
+
+    for name in sameName.keys():
+        files = sameName[name]
+        common = os.path.commonprefix(map(os.path.dirname, files))
+        common = common[:string.rfind(common, os.sep) + 1]
+        for f in files:
+            if len(files) > 1:
+                outputNames[f] = string.replace(libraryio.stripCompression(f)[len(common):], os.sep, '_')
+            else:
+                outputNames[f] = name
+
+    if os.environ.get('LIBRARYOUTPUTNAME'):
+        outputNames[inputFileNames[0]] = os.environ['LIBRARYOUTPUTNAME']
+
+    if selectFileName:
+        try:
+            selection = libraryformat.readSelection(selectFileName)
+        except IOError:
+            exit(1, 'Could not open file %s\n' % selectFileName)
+
+    if planFileName and mode == 'preview':
+        try:
+            planFile = open(planFileName, 'w')
+        except:
+            exit(1, 'Could not open file %s\n' % planFileName)
+
+    return
+
+def openFiles(
+    fileName	# input file name (string)
+    ):
+    # Purpose: open an input file and its diagnostics and error files
+    # Returns: nothing
+    # Assumes: nothing
+    # Effects: initializes global variables
+    #          exits if files cannot be opened
+    # Throws: nothing
+
+    global inputFileName, inputFile, diagFile, errorFile, errorFileName, diagFileName
+    global invalidValues, filesProcessed, fileStart, fileSqlCount
+
+    inputFileName = fileName
+    fileStart = time.time()
+    fileSqlCount = dbreplay.sqlCount
+
     fdate = mgi_utils.date('%m%d%Y')	# current date
-    head, tail = os.path.split(inputFileName) 
-    diagFileName = tail + '.' + fdate + '.diagnostics'
-    errorFileName = tail + '.' + fdate + '.error'
+    tail = outputNames.get(inputFileName)
+    if tail is None:
+        head, tail = os.path.split(libraryio.stripCompression(inputFileName))
+
+    if shardIndex is not None:
+        tail = tail + '.shard%d' % (shardIndex)
+
+    try:
+        diagFileName = libraryio.outputName(tail + '.' + fdate + '.diagnostics', compression)
+        errorFileName = libraryio.outputName(tail + '.' + fdate + '.error', compression)
+    except ValueError, message:
+        exit(1, message)
 
     try:
-        inputFile = open(inputFileName, 'r')
+        inputFile = libraryio.openFile(inputFileName, 'r')
     except:
         exit(1, 'Could not open file %s\n' % inputFileName)
 		
     try:
-        diagFile = open(diagFileName, 'w')
+        diagFile = libraryio.openFile(diagFileName, 'w')
     except:
         exit(1, 'Could not open file %s\n' % diagFileName)
 		
     try:
-        errorFile = open(errorFileName, 'w')
+        errorFile = libraryio.openFile(errorFileName, 'w')
     except:
         exit(1, 'Could not open file %s\n' % errorFileName)
 		
@@ -260,300 +779,2197 @@ def init():
     diagFile.write('Database: %s\n' % (db.get_sqlDatabase()))
     diagFile.write('Input File: %s\n' % (inputFileName))
 
+    if len(inputFileNames) > 1:
+        diagFile.write('Input File %d of %d\n' % (filesProcessed + 1, len(inputFileNames)))
+
+    if planFile is not None:
+        diagFile.write('Plan File: %s\n' % (planFileName))
+
+    if selection is not None:
+        diagFile.write('Selection File: %s (%d libraries)\n' % (selectFileName, len(selection)))
+
+    if len(fieldMask) < len(MASKPARTS):
+        diagFile.write('Field Mask: %s\n' % (string.join(filter(fieldMask.has_key, MASKPARTS), ',')))
+
     errorFile.write('Start Date/Time: %s\n\n' % (mgi_utils.date()))
 
+    if filesProcessed == 0:
+        loadVocabCache()
+
+    # invalid values are reported per input file;
+    # the caches are kept for the whole run
+    invalidValues = {}
+
+    return
+
+def closeFiles():
+    # Purpose: close the current input file and its diagnostics and error files
+    # Returns: nothing
+    # Assumes: nothing
+    # Effects: nothing
+    # Throws: nothing
+
+    global inputFile, diagFile, errorFile, filesProcessed
+
+    if inputFile != '':
+        countMetric('db_calls', dbreplay.sqlCount - fileSqlCount)
+        countMetric('seconds', time.time() - fileStart)
+
+    try:
+        inputFile.close()
+        diagFile.write('\n\nEnd Date/Time: %s\n' % (mgi_utils.date()))
+        errorFile.write('\n\nEnd Date/Time: %s\n' % (mgi_utils.date()))
+        diagFile.close()
+        errorFile.close()
+    except:
+        pass
+
+    inputFile = ''
+    diagFile = ''
+    errorFile = ''
+    filesProcessed = filesProcessed + 1
+
+    # SQL run after the input files (the plan guard, statistics) goes to the run log
+    db.set_sqlLogFD(sys.stdout)
+
+    return
+
+def readInput():
+    # Purpose: read the lines of the current input file;
+    #          an indexed file is read through its index.
+    #          if a selection is set, only the selected libraries are read
+    #          (each keeps its line number in the whole file)
+    # Returns: tuple (list of line numbers, list of tab-delimited lines)
+    # Assumes: the input file is open
+    # Effects: exits if an indexed file cannot be read
+    # Throws: nothing
+
+    try:
+        if libraryformat.isIndexed(inputFileName):
+            entries = libraryformat.readNumberedLines(inputFileName, selection)
+            return (map(lambda e: e[0], entries), map(lambda e: e[1], entries))
+    except (IOError, ValueError), message:
+        exit(1, 'Could not read file %s: %s\n' % (inputFileName, message))
+
+    lines = inputFile.readlines()
+
+    if selection is None:
+        return (range(1, len(lines) + 1), lines)
+
+    lineNums = []
+    selected = []
+    lineNum = 0
+    for line in lines:
+        lineNum = lineNum + 1
+        tokens = string.split(line[:-1], TAB)
+        if len(tokens) < 3 or libraryformat.isSelected(selection, tokens[0], tokens[2]):
+            lineNums.append(lineNum)
+            selected.append(line)
+
+    return (lineNums, selected)
+
+def loadVocabCache():
+    # Purpose: read the shared vocabulary cache, if one is configured
+    # Returns: nothing
+    # Assumes: nothing
+    # Effects: initializes vocabCache
+    # Throws: nothing
+
+    global vocabCache
+
+    if not vocabCacheFileName or not os.path.exists(vocabCacheFileName):
+        return
+
+    try:
+        fp = open(vocabCacheFileName, 'rb')
+        vocabCache = cPickle.load(fp)
+        fp.close()
+    except:
+        diagFile.write('Could not read vocabulary cache %s\n' % (vocabCacheFileName))
+        vocabCache = {}
+        return
+
+    diagFile.write('Vocabulary Cache: %s (%d terms)\n' % (vocabCacheFileName, len(vocabCache)))
+
+    return
+
+def saveVocabCache():
+    # Purpose: merge this run's verified terms into the shared vocabulary cache
+    # Returns: nothing
+    # Assumes: nothing
+    # Effects: rewrites the vocabulary cache file under an exclusive lock
+    # Throws: IOError if the cache file cannot be written
+
+    if not vocabCacheFileName or len(vocabCache) == 0:
+        return
+
+    lockFile = open(vocabCacheFileName + '.lock', 'w')
+    fcntl.flock(lockFile, fcntl.LOCK_EX)
+
+    try:
+        cache = {}
+        if os.path.exists(vocabCacheFileName):
+            fp = open(vocabCacheFileName, 'rb')
+            cache = cPickle.load(fp)
+            fp.close()
+
+        cache.update(vocabCache)
+
+        fp = open(vocabCacheFileName + '.new', 'wb')
+        cPickle.dump(cache, fp, 2)
+        fp.close()
+        os.rename(vocabCacheFileName + '.new', vocabCacheFileName)
+    finally:
+        fcntl.flock(lockFile, fcntl.LOCK_UN)
+        lockFile.close()
+
+    return
+
+def verifyTerm(
+    field,	# vocabulary field (key of verifyLookup)
+    value,	# term to verify (string)
+    lineNum,	# input line number (integer)
+    errorFD	# error file descriptor (or None)
+    ):
+    # Purpose: verify a vocabulary term, consulting the vocabulary cache
+    #          and the invalid value cache first
+    # Returns: the term's key, or 0 if the term is invalid
+    # Assumes: nothing
+    # Effects: caches the key of a successfully verified term,
+    #          or caches and records an invalid term (see noteInvalid())
+    # Throws: nothing
+
+    cacheKey = (field, value)
+
+    if vocabCache.has_key(cacheKey):
+        return vocabCache[cacheKey]
+
+    if not invalidCache.has_key(cacheKey):
+        key = verifyLookup[field](value, lineNum, None)
+        if key != 0:
+            vocabCache[cacheKey] = key
+            return key
+        invalidCache[cacheKey] = 1
+
+    if errorFD is not None:
+        noteInvalid(field, value, lineNum)
+
+    return 0
+
+def noteInvalid(
+    field,	# field name (string)
+    value,	# invalid value (string)
+    lineNum	# input line number (integer)
+    ):
+    # Purpose: record an occurrence of an invalid value
+    # Returns: nothing
+    # Assumes: nothing
+    # Effects: updates invalidValues
+    # Throws: nothing
+
+    cacheKey = (field, value)
+
+    if not invalidValues.has_key(cacheKey):
+        invalidValues[cacheKey] = [0, []]
+
+    occurrences = invalidValues[cacheKey]
+    occurrences[0] = occurrences[0] + 1
+    if len(occurrences[1]) < MAXINVALIDLINES:
+        occurrences[1].append(lineNum)
+
+    return
+
+def reportInvalid():
+    # Purpose: write one line per distinct invalid value to the error file,
+    #          with its number of occurrences and its first few line numbers
+    # Returns: nothing
+    # Assumes: nothing
+    # Effects: writes to the error file
+    # Throws: nothing
+
+    keys = invalidValues.keys()
+    keys.sort()
+
+    for field, value in keys:
+        count, lineNums = invalidValues[(field, value)]
+        lines = string.join(map(str, lineNums), ', ')
+        if count > len(lineNums):
+            lines = lines + ', ...'
+        errorFile.write('Invalid %s: %s (%d occurrences; lines: %s)\n' % (field, value, count, lines))
+
     return
 
 def verifyMode():
-    # Purpose: verifies the processing mode
+    # Purpose: verifies the processing mode and the commit size bounds
     # Returns: nothing
     # Assumes: nothing
     # Effects: exits with status 1 if the processing mode is invalid
     #          else sets global DEBUG based on processing mode
+    #          and clamps commitSize to its bounds
     # Throws: nothing
 
-    global DEBUG
+    global DEBUG, commitSize
 
     if mode == 'preview':
         DEBUG = 1
+    elif mode == 'apply':
+        if not planFileName:
+            exit(1, 'Apply Mode requires LIBRARYPLANFILE\n')
     elif mode != 'full':
         exit(1, 'Invalid Processing Mode:  %s\n' % (mode))
 
+    for part in fieldMask.keys():
+        if part not in MASKPARTS:
+            exit(1, 'Invalid LIBRARYFIELDMASK: %s\n' % (part))
+
+    if curatorPolicy not in ['accessions', 'skip', 'none']:
+        exit(1, 'Invalid LIBRARYCURATORPOLICY: %s\n' % (curatorPolicy))
+
+    if duplicatePolicy not in ['last', 'first', 'reject']:
+        exit(1, 'Invalid LIBRARYDUPLICATES: %s\n' % (duplicatePolicy))
+
+    if planFileName and shardCount > 1:
+        exit(1, 'LIBRARYPLANFILE cannot be used with LIBRARYSHARDS\n')
+
+    if watchDirName and (mode == 'apply' or planFileName or dbReplayFileName):
+        exit(1, 'LIBRARYWATCHDIR cannot be used with apply mode, LIBRARYPLANFILE or LIBRARYDBREPLAY\n')
+
+    # adaptive commit size: start from LIBRARYCOMMITSIZE, within the bounds
+
+    if commitMax > 0:
+        if commitMin < 1 or commitMin > commitMax or commitTarget <= 0:
+            exit(1, 'Invalid LIBRARYCOMMITMIN/LIBRARYCOMMITMAX/LIBRARYCOMMITTARGET\n')
+        commitSize = min(max(commitSize, commitMin), commitMax)
+
     return
 
-def processFile():
-    # Purpose: processes input file
-    # Returns: nothing
+def sqlList(
+    values	# list of strings
+    ):
+    # Purpose: format values as the contents of a SQL IN-list
+    # Returns: string
     # Assumes: nothing
     # Effects: nothing
     # Throws: nothing
 
-    global libraryName, libraryID, libraryKey, logicalDBKey
-    global segmentTypeKey, vectorTypeKey, organismKey, referenceKey, strainKey, tissueKey
-    global age, ageMin, ageMax, genderKey, cellLineKey, createdByKey
-    global strainNS, tissueNS, genderNS, cellLineNS, ageNS
+    return string.join(map(lambda v: '"%s"' % (string.replace(v, '"', '""')), values), ',')
 
-    lineNum = 0
+def preResolve(
+    lines	# list of input lines
+    ):
+    # Purpose: resolve the distinct vocabulary terms of the input file which are not
+    #          already cached with one IN-list query per field (see preResolveQueries),
+    #          and parse each distinct Age once
+    # Returns: nothing
+    # Assumes: nothing
+    # Effects: adds the resolved keys to vocabCache and ageCache
+    #          values which are not resolved here are verified (and reported)
+    #          as they are encountered in processFile()
+    # Throws: nothing
 
-    # retrieve next available primary key for Library record
-    results = db.sql('select maxKey = max(_Source_key) + 1 from %s' % (libraryTable), 'auto')
-    newlibraryKey = results[0]['maxKey']
+    queries = preResolveQueries
+    if not fieldMask.has_key('attributes'):
+        queries = filter(lambda q: q[0] not in attributeVocabularies, queries)
 
-    strainNS = sourceloadlib.verifyStrain(NS, 0, None)
-    tissueNS = sourceloadlib.verifyTissue(NS, 0, None)
-    genderNS = sourceloadlib.verifyGender(NS, 0, None)
-    cellLineNS = sourceloadlib.verifyCellLine(NS, 0, None)
-    ageNS = NS
+    distinct = {}
+    for field, column, cmd in queries:
+        distinct[field] = {}
+    ages = {}
 
-    # For each line in the input file
+    for line in lines:
+        tokens = string.split(line[:-1], TAB)
+        if len(tokens) != 15:
+            continue
+        for field, column, cmd in queries:
+            distinct[field][tokens[column]] = 1
+        if fieldMask.has_key('attributes'):
+            ages[tokens[8]] = 1
+
+    for field, column, cmd in queries:
+        values = filter(lambda v: len(v) > 0 and not vocabCache.has_key((field, v)), distinct[field].keys())
+        resolved = 0
+        for i in range(0, len(values), MAXINLIST):
+            for r in db.sql(cmd % (sqlList(values[i:i + MAXINLIST])), 'auto'):
+                if distinct[field].has_key(r['value']):
+                    vocabCache[(field, r['value'])] = r['objectKey']
+                    resolved = resolved + 1
+        if len(values) > 0:
+            diagFile.write('Resolved %s: %d of %d uncached terms\n' % (field, resolved, len(values)))
+
+    for a in ages.keys():
+        verifyAge(a, 0, None)
 
-    for line in inputFile.readlines():
+    return
 
-        error = 0
-        lineNum = lineNum + 1
+def verifyAge(
+    age,	# age (string)
+    lineNum,	# input line number (integer)
+    errorFD	# error file descriptor (or None)
+    ):
+    # Purpose: verify an age, consulting the age cache
+    #          and the invalid value cache first
+    # Returns: (ageMin, ageMax); ageMin is None if the age is invalid
+    # Assumes: nothing
+    # Effects: caches the range of a successfully verified age,
+    #          or caches and records an invalid age (see noteInvalid())
+    # Throws: nothing
 
-        # Split the line into tokens
+    if ageCache.has_key(age):
+        return ageCache[age]
 
-        try:
-            [libraryName, \
-	     logicalDB, \
-	     libraryID, \
-	     segmentType, \
-	     vectorType, \
-	     organism, \
-	     strain, \
-	     tissue, \
-	     age, \
-	     gender, \
-	     cellLine, \
-	     jnum, \
-	     note, \
-	     cloneCollections, \
-	     createdBy] = string.split(line[:-1], TAB)
-        except:
-            exit(1, 'Invalid Line (line: %d): %s\n' % (lineNum, line))
-            continue
+    if not invalidCache.has_key(('Age', age)):
+        ageMin, ageMax = sourceloadlib.verifyAge(age, lineNum, None)
+        if ageMin is not None:
+            ageCache[age] = (ageMin, ageMax)
+            return ageMin, ageMax
+        invalidCache[('Age', age)] = 1
 
-        libraryKey = sourceloadlib.verifyLibrary(libraryName, lineNum)
-
-	if len(logicalDB) > 0:
-            logicalDBKey = loadlib.verifyLogicalDB(logicalDB, lineNum, errorFile)
-	else:
-            logicalDBKey = 0
-
-	if libraryKey == 0 and len(libraryID) > 0:
-	    libraryKey = sourceloadlib.verifyLibraryID(libraryID, logicalDBKey, lineNum, errorFile)
-
-	segmentTypeKey = sourceloadlib.verifySegmentType(segmentType, lineNum, errorFile)
-	vectorTypeKey = sourceloadlib.verifyVectorType(vectorType, lineNum, errorFile)
-        strainKey = sourceloadlib.verifyStrain(strain, lineNum, errorFile)
-        tissueKey = sourceloadlib.verifyTissue(tissue, lineNum, errorFile)
-        genderKey = sourceloadlib.verifyGender(gender, lineNum, errorFile)
-        cellLineKey = sourceloadlib.verifyCellLine(cellLine, lineNum, errorFile)
-        ageMin, ageMax = sourceloadlib.verifyAge(age, lineNum, errorFile)
-        referenceKey = loadlib.verifyReference(jnum, lineNum, errorFile)
-	createdByKey = loadlib.verifyUser(createdBy, lineNum, errorFile)
-
-        if segmentTypeKey == 0 or \
-	   vectorTypeKey == 0 or \
-           strainKey == 0 or \
-           tissueKey == 0 or \
-           genderKey == 0 or \
-	   cellLineKey == 0 or \
-	   organismKey == 0 or \
-           referenceKey == 0 or \
-	   createdByKey == 0 or \
-	   ageMin is None:
-            # set error flag to true
-            error = 1
-#	    print str(segmentTypeKey)
-#	    print str(vectorTypeKey)
-#	    print str(strainKey)
-#	    print str(tissueKey)
-#	    print str(genderKey)
-#	    print str(cellLineKey)
-#	    print str(organismKey)
-#	    print str(referenceKey)
-#	    print str(createdByKey)
-#	    print str(ageMin)
-	    errorFile.write('Errors:  %s\n' % (libraryName))
-
-        # if errors, continue to next record
-        if error:
-            continue
+    if errorFD is not None:
+        noteInvalid('Age', age, lineNum)
 
-        # if no errors, continue processing
+    return None, None
 
-        # process new library
-        if libraryKey == 0:
+def shardOf(
+    line	# input line (string)
+    ):
+    # Purpose: assign an input line to a shard by the hash of its library name
+    # Returns: shard number (0..shardCount-1)
+    # Assumes: nothing
+    # Effects: nothing
+    # Throws: nothing
 
-            libraryKey = newlibraryKey
-            addLibrary()
+    return (zlib.crc32(string.split(line, TAB, 1)[0]) & 0x7fffffff) % shardCount
 
-	    # increment primary keys
-            newlibraryKey = newlibraryKey + 1
+def runShards():
+    # Purpose: run a sharded load:
+    #          partition the input by library name across shardCount worker processes,
+    #          reserve a disjoint block of _Source_key and _SetMember_key values for each,
+    #          and of sequenceNum values in each clone collection it adds to,
+    #          run the workers (each with its own connection),
+    #          then merge their diagnostics and error files into this process's files
+    # Returns: nothing
+    # Assumes: no other process adds PRB_Source or MGI_SetMember records during the load
+    # Effects: exits with status 1 if any worker fails
+    # Throws: nothing
 
-	# else, process existing library
-        else:
-            updateLibrary()
+    startTime = startPhase('shards')
+    lineNums, inputLines = readInput()
+
+    # malformed lines are reported here, once; the workers skip them
+    scanInput(inputLines, lineNums, 1)
 
-	addCloneCollections(cloneCollections)
+    # each worker may add at most one library per input line
+    # and one member per clone collection of each line
+
+    sourceBlocks = [0] * shardCount
+    memberBlocks = [0] * shardCount
+    seqBlocks = []	# per shard: _Set_key -> members added
+    for shard in range(shardCount):
+        seqBlocks.append({})
+
+    for line in inputLines:
+        shard = shardOf(line)
+        sourceBlocks[shard] = sourceBlocks[shard] + 1
+        memberBlocks[shard] = memberBlocks[shard] + string.count(line, '|') + 1
+
+        tokens = string.split(line[:-1], TAB)
+        if not fieldMask.has_key('collections') or len(tokens) < 14:
+            continue
+        for c in string.split(tokens[13], '|'):
+            setKey = verifySet(c)
+            if setKey != 0:
+                seqBlocks[shard][setKey] = seqBlocks[shard].get(setKey, 0) + 1
+
+    sourceKey = db.sql('select maxKey = max(_Source_key) + 1 from %s' % (libraryTable), 'auto')[0]['maxKey']
+    memberKey = db.sql('select maxKey = max(_SetMember_key) + 1 from %s' % (memberTable), 'auto')[0]['maxKey']
+
+    # next sequenceNum of each clone collection any shard adds to (read once)
+
+    seqNums = {}
+    for shard in range(shardCount):
+        for setKey in seqBlocks[shard].keys():
+            if not seqNums.has_key(setKey):
+                seqNum = db.sql('select maxSeq = max(sequenceNum) + 1 from %s where _Set_key = %s' \
+		    % (memberTable, setKey), 'auto')[0]['maxSeq']
+                if seqNum is None:
+                    seqNum = 1
+                seqNums[setKey] = seqNum
+
+    workers = []
+
+    for shard in range(shardCount):
+
+        env = os.environ.copy()
+        env['LIBRARYINPUTFILE'] = inputFileName
+        env['LIBRARYSHARDINDEX'] = str(shard)
+        env['LIBRARYSOURCEKEY'] = str(sourceKey)
+        env['LIBRARYMEMBERKEY'] = str(memberKey)
+        env['LIBRARYOUTPUTNAME'] = outputNames.get(inputFileName, '')
+
+        reserved = []
+        for setKey in seqBlocks[shard].keys():
+            reserved.append('%s:%s' % (setKey, seqNums[setKey]))
+            seqNums[setKey] = seqNums[setKey] + seqBlocks[shard][setKey]
+        env['LIBRARYSEQNUMS'] = string.join(reserved, ',')
+
+        diagFile.write('Shard %d: %d lines, _Source_key %d-%d, _SetMember_key %d-%d, sequenceNum %s\n' \
+	    % (shard, sourceBlocks[shard], sourceKey, sourceKey + sourceBlocks[shard] - 1, \
+	    memberKey, memberKey + memberBlocks[shard] - 1, env['LIBRARYSEQNUMS']))
+
+        workers.append(subprocess.Popen([sys.executable] + sys.argv, env = env))
+
+        sourceKey = sourceKey + sourceBlocks[shard]
+        memberKey = memberKey + memberBlocks[shard]
+
+    status = 0
+
+    for shard in range(shardCount):
+
+        workerStatus = workers[shard].wait()
+        if workerStatus != 0:
+            status = 1
+            errorFile.write('Shard %d failed with exit status %d\n' % (shard, workerStatus))
+
+        if metricsFileName:
+            mergeShardMetrics(metricsFileName + '.shard%d' % (shard))
+
+        # merge the worker's diagnostics and error files
+
+        for fileName, fp in [(diagFileName, diagFile), (errorFileName, errorFile)]:
+            base = libraryio.stripCompression(fileName)
+            i = string.rfind(base, '.')
+            i = string.rfind(base, '.', 0, i)
+            shardFileName = libraryio.outputName(base[:i] + '.shard%d' % (shard) + base[i:], compression)
+            try:
+                shardFile = libraryio.openFile(shardFileName, 'r')
+            except:
+                continue
+            fp.write('\n### Shard %d ###\n' % (shard))
+            for line in shardFile:
+                fp.write(line)
+                match = re.match(r'Rows Changed \((\w+)\): (\d+)$', line)
+                if fp is diagFile and match is not None:
+                    table = match.group(1)
+                    tableChanges[table] = tableChanges.get(table, 0) + int(match.group(2))
+            shardFile.close()
+            os.remove(shardFileName)
+
+    timePhase('shards', startTime)
+
+    if status != 0:
+        exit(1, 'Sharded load failed; see %s\n' % (errorFileName))
 
     return
 
-def addLibrary():
-    # Purpose: executes sql for a new library
-    # Returns: nothing
+def scanInput(
+    lines,	# list of input lines
+    lineNums,	# line number in the input file of each line (list of integers)
+    report	# true to report the malformed lines (boolean)
+    ):
+    # Purpose: check the structure of every input line, without database access:
+    #          the number of fields, the encoding (UTF-8, no control characters),
+    #          the line ending (no carriage return, final newline present)
+    #          and that no required field is empty
+    # Returns: dictionary of the positions (1 = first of lines) of the malformed lines
     # Assumes: nothing
-    # Effects: nothing
+    # Effects: if report, writes each problem to the error file
+    #          exits with status 1 if there are more malformed lines than scanTolerance
     # Throws: nothing
 
-    diagFile.write('Adding Library...%s.\n' % (libraryName))
+    malformed = {}
+    nfields = len(LibraryRecord.inputFields)
+
+    required = requiredFields
+    if fieldMask.has_key('attributes'):
+        required = required + requiredAttributeFields
 
-    # write master Library record
-    addCmd = 'insert into PRB_Source values(%s,%s,%s,%s,%s,%s,%s,%s,%s,"%s",%s,"%s",%s,%s,%s,%s,%s,"%s","%s") ' \
-	% (libraryKey, segmentTypeKey, vectorTypeKey, organismKey, \
-	strainKey, tissueKey, genderKey, cellLineKey, referenceKey, libraryName, description, \
-	age, ageMin, ageMax, isCuratorEdited, createdByKey, createdByKey, loaddate, loaddate)
-    db.sql(addCmd, None, execute = not DEBUG)
+    lineNum = 0
+    for line in lines:
 
-    # write Accession records
-    if len(libraryID) > 0:
-	addCmd = 'exec ACC_insert 1001,%s,"%s",%s,"%s"' % (libraryKey, libraryID, logicalDBKey, MGITYPE)
-	db.sql(addCmd, None, execute = not DEBUG)
+        lineNum = lineNum + 1
+        problems = []
 
-    return
+        if line[-1:] != CRT:
+            problems.append('no newline at end of file')
+            body = line
+        else:
+            body = line[:-1]
 
-def updateLibrary():
-    # Purpose: update the Clone Library record with the new values
-    # Returns: nothing
-    # Assumes: nothing
-    # Effects: nothing
-    # Throws: nothing
+        if body[-1:] == '\r':
+            problems.append('carriage return (CRLF) line ending')
+            body = body[:-1]
 
-    # for the given Library, read in each attribute and its current value
+        try:
+            unicode(body, 'utf-8')
+        except UnicodeError:
+            problems.append('not valid UTF-8')
 
-    setCmds = []
-    cmds = []
+        if re.search('[\x00-\x08\x0a-\x1f\x7f]', body) is not None:
+            problems.append('control character')
 
-    for columnName in libColNames:
-        cmds.append('select colName = "%s", value = convert(varchar(255), %s) ' % (columnName, columnName) + \
-            'from %s where _Source_key = %s' % (libraryTable, libraryKey))
+        tokens = string.split(body, TAB)
+
+        if len(tokens) != nfields:
+            problems.append('%d fields, expected %d' % (len(tokens), nfields))
+        else:
+            empty = filter(lambda i: len(string.strip(tokens[i])) == 0, required)
+            if len(empty) > 0:
+                problems.append('empty %s' % (string.join(map(lambda i: LibraryRecord.inputFields[i], empty), ', ')))
 
-    results = db.sql(string.join(cmds, '\nunion\n'), 'auto')
+        if len(problems) == 0:
+            continue
 
-    #  for each attribute, if it's value has changed, update it.
-    #  if the new attribute value = Not Specified, then don't update it.
-    #  we don't want to overwrite a value w/ "Not Specified".
+        malformed[lineNum] = 1
 
-    for r in results:
+        if report:
+            errorFile.write('Malformed Line (line: %d): %s\n' % (lineNums[lineNum - 1], string.join(problems, '; ')))
 
-        if r['colName'] == 'name' and r['value'] != libraryName:
-                setCmds.append('%s = "%s"' % (r['colName'], libraryName))
+    if report:
+        diagFile.write('Structural Scan: %d lines, %d malformed\n' % (len(lines), len(malformed)))
+        countMetric('malformed', len(malformed))
 
-        elif r['colName'] == '_SegmentType_key' and r['value'] != str(segmentTypeKey):
-                setCmds.append('%s = %s' % (r['colName'], segmentTypeKey))
+    if len(malformed) > scanTolerance:
+        exit(1, '%s has %d malformed lines (LIBRARYSCANTOLERANCE = %d); not loaded; see %s\n' \
+	    % (inputFileName, len(malformed), scanTolerance, errorFileName))
 
-        elif r['colName'] == '_Vector_key' and r['value'] != str(vectorTypeKey):
-                setCmds.append('%s = %s' % (r['colName'], vectorTypeKey))
+    return malformed
 
-        elif r['colName'] == '_Organism_key' and r['value'] != str(organismKey):
-                setCmds.append('%s = %s' % (r['colName'], organismKey))
+def coalesceLines(
+    lines,	# list of input lines
+    lineNums	# line number in the input file of each line (list of integers)
+    ):
+    # Purpose: find the input lines which repeat a Library Name, or a
+    #          Logical DB + Library ID, and coalesce each group of them into
+    #          one effective line according to duplicatePolicy
+    #          a line which is None (malformed; see scanInput()) is skipped
+    # Returns: list of (line number, line) to process, in input order
+    # Assumes: nothing
+    # Effects: reports each group of duplicates in the error file
+    # Throws: nothing
 
-        elif r['colName'] == '_Refs_key' and r['value'] != str(referenceKey):
-                setCmds.append('%s = %s' % (r['colName'], referenceKey))
+    groups = []		# list of positions in lines per library
+    groupOf = {}	# name or (logical DB, ID) -> index into groups
+    keysOf = []		# list of names and (logical DB, ID)s per library (the reverse of groupOf)
 
-        elif r['colName'] == '_Strain_key' and r['value'] != str(strainKey) and strainKey != strainNS:
-                setCmds.append('%s = %s' % (r['colName'], strainKey))
+    lineNum = 0
+    for line in lines:
 
-        elif r['colName'] == '_Tissue_key' and r['value'] != str(tissueKey) and tissueKey != tissueNS:
-                setCmds.append('%s = %s' % (r['colName'], tissueKey))
+        lineNum = lineNum + 1
 
-        elif r['colName'] == '_Gender_key' and r['value'] != str(genderKey) and genderKey != genderNS:
-                setCmds.append('%s = %s' % (r['colName'], genderKey))
+        if line is None:
+            continue
 
-        elif r['colName'] == '_CellLine_key' and r['value'] != str(cellLineKey) and cellLineKey != cellLineNS:
-                setCmds.append('%s = %s' % (r['colName'], cellLineKey))
+        tokens = string.split(line[:-1], TAB)
+
+        keys = [('name', tokens[0])]
+        if len(tokens) > 2 and len(tokens[2]) > 0:
+            keys.append(('id', tokens[1], tokens[2]))
+
+        group = None
+        for key in keys:
+            if groupOf.has_key(key):
+                other = groupOf[key]
+                if group is None:
+                    group = other
+                elif other != group:
+                    # the line joins two groups; move the smaller group into the larger
+                    if len(keysOf[other]) > len(keysOf[group]):
+                        group, other = other, group
+                    groups[group] = groups[group] + groups[other]
+                    groups[other] = []
+                    for k in keysOf[other]:
+                        groupOf[k] = group
+                    keysOf[group] = keysOf[group] + keysOf[other]
+                    keysOf[other] = []
+
+        if group is None:
+            group = len(groups)
+            groups.append([])
+            keysOf.append([])
+
+        groups[group].append(lineNum)
+        for key in keys:
+            if not groupOf.has_key(key):
+                keysOf[group].append(key)
+            groupOf[key] = group
+
+    keep = {}
+
+    for group in groups:
+
+        if len(group) == 0:
+            continue
 
-        elif r['colName'] == 'age' and r['value'] != age and age != NS:
-                setCmds.append('%s = "%s"' % (r['colName'], age))
-                setCmds.append('ageMin = %s' % (ageMin))
-                setCmds.append('ageMax = %s' % (ageMax))
+        if len(group) == 1:
+            keep[group[0]] = 1
+            continue
 
-    # if there were any attribute value changes, then execute the update
+        group.sort()
+        groupLines = string.join(map(lambda n: str(lineNums[n - 1]), group), ', ')
 
-    if len(setCmds) > 0:
-	diagFile.write('Updating Library...%s.\n' % (libraryName))
-        setCmds.append('_ModifiedBy_key = %s' % (createdByKey))
-        setCmds.append('modification_date = getdate()')
-        setCmd = string.join(setCmds, ',')
-        db.sql('update %s set %s where _Source_key = %s' % (libraryTable, setCmd, libraryKey), \
-	    None, execute = not DEBUG)
+        if duplicatePolicy == 'first':
+            used = group[0]
+        else:
+            used = group[-1]
 
-    # if accession id has changed, update it
+        if duplicatePolicy != 'reject':
+            keep[used] = 1
 
-    if len(libraryID) > 0:
-        results = db.sql('select _Accession_key, accID ' + \
-            'from ACC_Accession ' + \
-            'where _MGIType_key = 5 ' + \
-	    'and _LogicalDB_key = %s ' % (logicalDBKey) + \
-            'and _Object_key = %s ' % (libraryKey), 'auto')
+        # a shard worker reports only the duplicates it loads
+        if shardIndex is not None and shardOf(lines[used - 1]) != shardIndex:
+            continue
 
-        for r in results:
-            if r['accID'] != libraryID:
-                db.sql('exec ACC_update 1001,%s,"%s"' % (r['_Accession_key'], libraryID), None)
+        name = string.split(lines[used - 1], TAB, 1)[0]
 
-    return
+        if duplicatePolicy == 'reject':
+            errorFile.write('Duplicate Library (lines: %s): %s; not loaded\n' % (groupLines, name))
+        else:
+            errorFile.write('Duplicate Library (lines: %s): %s; using line %d\n' \
+		% (groupLines, name, lineNums[used - 1]))
 
-def addCloneCollections(cloneCollections):
-    # cloneCollections: |-delimited string of clone collections
+    entries = []
+    lineNum = 0
+    for line in lines:
+        lineNum = lineNum + 1
+        if keep.has_key(lineNum):
+            entries.append((lineNums[lineNum - 1], line))
+
+    return entries
+
+def loadFile(
+    fileName	# input file name (string)
+    ):
+    # Purpose: load one input file; if it fails, roll back its open transaction
+    #          and report it, without stopping the run
+    # Returns: 0 if the file was loaded, else 1
+    # Assumes: nothing
+    # Effects: modifies the database unless in preview mode;
+    #          opens and closes the file's diagnostics and error files
+    # Throws: dbreplay.ReplayError if a replayed query is not in the trace;
+    #         KeyboardInterrupt, SystemExit
+
+    global loadingFileName, inTransaction, uncommitted
+
+    status = 0
+    loadingFileName = fileName
 
-    # Purpose: executes sql for a Clone Collections
+    try:
+        openFiles(fileName)
+        if shardCount > 1 and shardIndex is None:
+            runShards()
+        else:
+            processFile()
+    except dbreplay.ReplayError:
+        loadingFileName = None
+        raise
+    except (FileError, Exception):
+        # KeyboardInterrupt and SystemExit stop the run
+        status = 1
+        message = sys.exc_info()[1]
+        if inTransaction:
+            try:
+                db.sql('rollback transaction', None)
+            except:
+                pass
+            inTransaction = 0
+            uncommitted = 0
+        sys.stderr.write('%s: could not load %s: %s\n' % (mgi_utils.date(), fileName, string.strip(str(message))))
+        try:
+            errorFile.write('Could not load file %s: %s\n' % (fileName, message))
+        except:
+            pass
+
+    loadingFileName = None
+    closeFiles()
+
+    return status
+
+def processFile():
+    # Purpose: processes input file
+    #          each line is verified into a LibraryRecord; verified records
+    #          are written in batches of batchSize
     # Returns: nothing
     # Assumes: nothing
     # Effects: nothing
     # Throws: nothing
 
-    diagFile.write('Adding Clone Collections...%s, Library = %s.\n' % (cloneCollections, libraryName))
+    global strainNS, tissueNS, genderNS, cellLineNS, ageNS, nextLibraryKey, nextMemberKey
+    global rowsRead, linesDone, linesTotal
 
-    results = db.sql('select maxKey = max(_SetMember_key) + 1 from %s' % (memberTable), 'auto')
-    memberKey = results[0]['maxKey']
+    # retrieve next available primary key for Library record
+    # (a shard worker uses the keys reserved for it by the coordinator)
+
+    if shardIndex is not None:
+        nextLibraryKey = int(os.environ['LIBRARYSOURCEKEY'])
+        nextMemberKey = int(os.environ['LIBRARYMEMBERKEY'])
+        for reserved in string.split(os.environ.get('LIBRARYSEQNUMS', ''), ','):
+            if len(reserved) > 0:
+                setKey, seqNum = string.split(reserved, ':')
+                nextSeqNums[int(setKey)] = int(seqNum)
+    elif nextLibraryKey == 0 and fieldMask.has_key('attributes'):
+        results = db.sql('select maxKey = max(_Source_key) + 1 from %s' % (libraryTable), 'auto')
+        nextLibraryKey = results[0]['maxKey']
+
+    if fieldMask.has_key('attributes'):
+        strainNS = verifyTerm('Strain', NS, 0, None)
+        tissueNS = verifyTerm('Tissue', NS, 0, None)
+        genderNS = verifyTerm('Gender', NS, 0, None)
+        cellLineNS = verifyTerm('Cell Line', NS, 0, None)
+        ageNS = NS
+
+    # every shard worker coalesces the whole file, so duplicates
+    # which span shards are resolved the same way by all of them
+
+    startTime = startPhase('read')
+    lineNums, inputLines = readInput()
+    timePhase('read', startTime)
+
+    startTime = startPhase('scan')
+    malformed = scanInput(inputLines, lineNums, shardIndex is None)
+    timePhase('scan', startTime)
+
+    startTime = startPhase('coalesce')
+    lines = inputLines
+    if len(malformed) > 0:
+        lines = []
+        for i in range(len(inputLines)):
+            if malformed.has_key(i + 1):
+                lines.append(None)
+            else:
+                lines.append(inputLines[i])
+
+    entries = coalesceLines(lines, lineNums)
+
+    if shardIndex is not None:
+        entries = filter(lambda e: shardOf(e[1]) == shardIndex, entries)
+        inputLines = filter(lambda line: shardOf(line) == shardIndex, inputLines)
+
+    rowsRead = rowsRead + len(inputLines)
+    countMetric('rows_read', len(inputLines))
+    timePhase('coalesce', startTime)
+
+    startTime = startPhase('resolve')
+    preResolve(map(lambda e: e[1], entries))
+    timePhase('resolve', startTime)
+
+    batch = []
+    startPhase('load')
+    linesTotal = len(entries)
 
-    # delete existing clone collections for this library
+    # For each line in the input file
 
-    db.sql('delete MGI_SetMember from MGI_Set s, MGI_SetMember sm ' + \
-	'where s._MGIType_key = %s ' % (MGITYPEKEY) + \
-	'and s._Set_key = sm._Set_key ' + \
-	'and sm._Object_key = %s' % (libraryKey), None, execute = not DEBUG)
+    for lineNum, line in entries:
 
-    cc = string.split(cloneCollections, '|')
-    for c in cc:
+        linesDone = linesDone + 1
+        writeStatus(0)
 
-	setKey = 0
-	results = db.sql('select _Set_key from %s where name = "%s"' % (setTable, c), 'auto')
-	for r in results:
-	    setKey = r['_Set_key']
+        # Split the line into tokens
+        # (scanInput() has checked that each line has every field)
 
-        if setKey == 0:
-            errorFile.write('Invalid Set: %s\n' % (c))
-	    continue
+        tokens = string.split(line[:-1], TAB)
 
-        seqNum = db.sql('select maxSeq = max(sequenceNum) + 1 from %s where _Set_key = %s' % (memberTable, setKey), 'auto')[0]['maxSeq']
+        record = LibraryRecord(lineNum, tokens)
 
-        # write Member record
-	db.sql('insert into %s values(%s,%s,%s,%d,%s,%s,"%s","%s") ' \
-		% (memberTable, memberKey, setKey, libraryKey, seqNum, createdByKey, createdByKey, loaddate, loaddate), None, execute = not DEBUG)
+        # if errors, report the library and continue to next record
+        # (the invalid values themselves are reported once each by reportInvalid())
+        startTime = time.time()
+        verified = verifyRecord(record)
+        timePhase('verify', startTime)
 
-	memberKey = memberKey + 1
+        if not verified:
+            errorFile.write('Errors:  %s (line: %d)\n' % (record.libraryName, lineNum))
+            countMetric('errored')
+            continue
 
-    return
+        # if no errors, continue processing
 
-#
-# Main
-#
+        batch.append(record)
+
+        if len(batch) >= batchSize:
+            startTime = time.time()
+            processBatch(batch)
+            timePhase('write', startTime)
+            batch = []
+
+    startTime = time.time()
+    processBatch(batch)
+    commitTransaction()
+    timePhase('write', startTime)
+
+    reportInvalid()
+
+    if curatorPolicy != 'none':
+        diagFile.write('Curator-Edited Libraries (%s): %d\n' \
+	    % (curatorPolicy, fileMetrics.get(inputFileName, {}).get('curator_edited', 0)))
+
+    # a shard worker reports the rows it changed to its coordinator (see runShards())
+
+    if shardIndex is not None:
+        for table in tableChanges.keys():
+            diagFile.write('Rows Changed (%s): %d\n' % (table, tableChanges[table]))
+
+    return
+
+def verifyRecord(
+    record	# LibraryRecord
+    ):
+    # Purpose: resolve each attribute of the record to its database key
+    #          (the vocabulary attributes only if attributes are loaded; see fieldMask)
+    # Returns: 1 if every attribute is valid, else 0
+    # Assumes: nothing
+    # Effects: sets the key attributes of the record
+    # Throws: nothing
+
+    lineNum = record.lineNum
+
+    record.libraryKey = sourceloadlib.verifyLibrary(record.libraryName, lineNum)
+
+    if len(record.logicalDB) > 0:
+        record.logicalDBKey = verifyTerm('Logical DB', record.logicalDB, lineNum, errorFile)
+    else:
+        record.logicalDBKey = 0
+
+    if record.libraryKey == 0 and len(record.libraryID) > 0:
+        record.libraryKey = sourceloadlib.verifyLibraryID(record.libraryID, record.logicalDBKey, lineNum, errorFile)
+
+    record.createdByKey = verifyTerm('User', record.createdBy, lineNum, errorFile)
+
+    # without attributes, only existing libraries can be loaded
+
+    if not fieldMask.has_key('attributes'):
+        if record.libraryKey == 0:
+            noteInvalid('Library (not in database)', record.libraryName, lineNum)
+            return 0
+        return record.createdByKey != 0
+
+    record.segmentTypeKey = verifyTerm('Segment Type', record.segmentType, lineNum, errorFile)
+    record.vectorTypeKey = verifyTerm('Vector Type', record.vectorType, lineNum, errorFile)
+    record.strainKey = verifyTerm('Strain', record.strain, lineNum, errorFile)
+    record.tissueKey = verifyTerm('Tissue', record.tissue, lineNum, errorFile)
+    record.genderKey = verifyTerm('Gender', record.gender, lineNum, errorFile)
+    record.cellLineKey = verifyTerm('Cell Line', record.cellLine, lineNum, errorFile)
+    record.ageMin, record.ageMax = verifyAge(record.age, lineNum, errorFile)
+    record.referenceKey = verifyTerm('Reference', record.jnum, lineNum, errorFile)
+
+    if record.segmentTypeKey == 0 or \
+       record.vectorTypeKey == 0 or \
+       record.strainKey == 0 or \
+       record.tissueKey == 0 or \
+       record.genderKey == 0 or \
+       record.cellLineKey == 0 or \
+       record.organismKey == 0 or \
+       record.referenceKey == 0 or \
+       record.createdByKey == 0 or \
+       record.ageMin is None:
+        return 0
+
+    return 1
+
+def findRepeat(
+    records	# list of verified LibraryRecords
+    ):
+    # Purpose: find the first new library of a batch which repeats the
+    #          Library Name, or Logical DB + Library ID, of a new library before it
+    # Returns: (index of the repeat, record it repeats), or (0, None) if there is none
+    # Assumes: nothing
+    # Effects: nothing
+    # Throws: nothing
+
+    pending = {}	# name or (logical DB, ID) -> record
+
+    for i in range(len(records)):
+
+        record = records[i]
+
+        if record.libraryKey != 0:
+            continue
+
+        keys = [('name', record.libraryName)]
+        if len(record.libraryID) > 0:
+            keys.append(('id', record.logicalDBKey, record.libraryID))
+
+        for key in keys:
+            if pending.has_key(key):
+                return i, pending[key]
+
+        for key in keys:
+            pending[key] = record
+
+    return 0, None
+
+def processBatch(
+    records	# list of verified LibraryRecords
+    ):
+    # Purpose: add or update a batch of verified libraries
+    #          and their clone collections
+    # Returns: nothing
+    # Assumes: nothing
+    # Effects: nothing
+    # Throws: nothing
+
+    global nextLibraryKey
+
+    if len(records) == 0:
+        return
+
+    # a library repeated within the batch is added by its first occurrence:
+    # the libraries before the repeat are loaded first, and the repeat then
+    # updates the library they added, as a line-by-line load would
+
+    i, first = findRepeat(records)
+    if i > 0:
+        processBatch(records[:i])
+        records[i].libraryKey = first.libraryKey
+        processBatch(records[i:])
+        return
+
+    newRecords = []
+    existingRecords = []
+
+    for record in records:
+
+        # process new library
+        if record.libraryKey == 0:
+            record.libraryKey = nextLibraryKey
+            record.isNew = 1
+            newRecords.append(record)
+
+            # increment primary keys
+            nextLibraryKey = nextLibraryKey + 1
+
+        # else, process existing library
+        else:
+            existingRecords.append(record)
+
+    addLibraries(newRecords)
+    updateLibraries(existingRecords)
+
+    if curatorPolicy == 'skip':
+        records = filter(lambda r: not r.curatorEdited, records)
+
+    if fieldMask.has_key('collections'):
+        addCloneCollections(records)
+
+    writeRecords(records)
+
+    return
+
+def addLibraries(
+    records	# list of new LibraryRecords
+    ):
+    # Purpose: creates sql for new libraries
+    # Returns: nothing
+    # Assumes: each record has been assigned a new library key
+    # Effects: appends to each record's cmds
+    # Throws: nothing
+
+    for r in records:
+
+        diagFile.write('Adding Library...%s.\n' % (r.libraryName))
+
+        # write master Library record
+        r.cmds.append('insert into PRB_Source values(%s,%s,%s,%s,%s,%s,%s,%s,%s,"%s",%s,"%s",%s,%s,%s,%s,%s,"%s","%s") ' \
+	    % (r.libraryKey, r.segmentTypeKey, r.vectorTypeKey, r.organismKey, \
+	    r.strainKey, r.tissueKey, r.genderKey, r.cellLineKey, r.referenceKey, r.libraryName, description, \
+	    r.age, r.ageMin, r.ageMax, isCuratorEdited, r.createdByKey, r.createdByKey, loaddate, loaddate))
+
+        # write Accession records
+        if len(r.libraryID) > 0:
+            r.cmds.append('exec ACC_insert 1001,%s,"%s",%s,"%s"' % (r.libraryKey, r.libraryID, r.logicalDBKey, MGITYPE))
+
+    return
+
+def updateLibraries(
+    records	# list of existing LibraryRecords
+    ):
+    # Purpose: reads the current values, curator flag and accession ids of a batch of
+    #          existing libraries (one query each) and creates the sql to update them;
+    #          curator-edited libraries are skipped or restricted per curatorPolicy
+    # Returns: nothing
+    # Assumes: nothing
+    # Effects: appends to each record's cmds; sets each record's curatorEdited
+    # Throws: nothing
+
+    if len(records) == 0:
+        return
+
+    keys = string.join(map(lambda r: str(r.libraryKey), records), ',')
+
+    # for the given Libraries, read in each attribute and its current value
+    # (only the curator flag if attributes are not loaded)
+
+    columns = []
+    if fieldMask.has_key('attributes'):
+        columns = ['isCuratorEdited'] + libColNames
+    elif curatorPolicy != 'none':
+        columns = ['isCuratorEdited']
+
+    current = {}
+    if len(columns) > 0:
+        results = db.sql('select _Source_key, %s from %s where _Source_key in (%s)' \
+	    % (string.join(columns, ', '), libraryTable, keys), 'auto')
+        for r in results:
+            current[r['_Source_key']] = r
+
+    accessions = {}
+    if fieldMask.has_key('accessions'):
+        results = db.sql('select _Accession_key, accID, _Object_key, _LogicalDB_key ' + \
+	    'from ACC_Accession ' + \
+	    'where _MGIType_key = %s ' % (MGITYPEKEY) + \
+	    'and _Object_key in (%s)' % (keys), 'auto')
+        for r in results:
+            if not accessions.has_key(r['_Object_key']):
+                accessions[r['_Object_key']] = []
+            accessions[r['_Object_key']].append(r)
+
+    updates = []
+
+    for record in records:
+
+        if len(columns) > 0 and not current.has_key(record.libraryKey):
+            continue
+
+        if curatorPolicy != 'none' and current[record.libraryKey]['isCuratorEdited'] == 1:
+            record.curatorEdited = 1
+            countMetric('curator_edited')
+            if curatorPolicy == 'skip':
+                diagFile.write('Skipping Curator-Edited Library...%s.\n' % (record.libraryName))
+                continue
+            diagFile.write('Curator-Edited Library...%s; updating Library ID and Clone Collections only.\n' \
+		% (record.libraryName))
+
+        updates.append(record)
+
+    # a curator-edited library keeps its attribute values
+
+    changed = {}
+    if fieldMask.has_key('attributes'):
+        diffRecords = filter(lambda r: not r.curatorEdited, updates)
+        masks = diffLibraries(diffRecords, current)
+        for i in range(len(diffRecords)):
+            changed[diffRecords[i].libraryKey] = masks[i]
+
+    for record in updates:
+        updateLibrary(record, changed.get(record.libraryKey, 0), accessions.get(record.libraryKey, []))
+
+    return
+
+def diffLibraries(
+    records,	# list of existing LibraryRecords
+    current	# _Source_key -> current PRB_Source row (dictionary)
+    ):
+    # Purpose: detects which columns (libColumns) of each library have changed:
+    #          the new and current values are compared as aligned integer columns,
+    #          each encoded in one pass (keys as is, names and ages by a code
+    #          per distinct value),
+    #          a new value equal to the column's Not Specified value is not a change
+    # Returns: list of bitmasks (see librarydiff.py), in the order of records
+    # Assumes: each record has a current row
+    # Effects: nothing
+    # Throws: nothing
+
+    columns = librarydiff.Columns(len(libColumns))
+    rows = map(current.__getitem__, map(operator.attrgetter('libraryKey'), records))
+
+    # string value -> code, shared by the new and current values;
+    # each column is encoded as a whole: a code is assigned once per distinct value
+    codes = {}
+
+    def encodeColumn(values, isString):
+        if isString:
+            values = map(str, values)
+            for value in dict.fromkeys(values).keys():
+                if not codes.has_key(value):
+                    codes[value] = len(codes)
+            return map(codes.__getitem__, values)
+        if None in values:
+            return map(lambda value: value is None and librarydiff.NULLVALUE or int(value), values)
+        return map(int, values)
+
+    i = 0
+    for colName, attribute, nsName, isString in libColumns:
+        columns.setColumn(i,
+	    encodeColumn(map(operator.attrgetter(attribute), records), isString),
+	    encodeColumn(map(operator.itemgetter(colName), rows), isString))
+        i = i + 1
+
+    nsValues = []
+    for colName, attribute, nsName, isString in libColumns:
+        if nsName is None:
+            nsValues.append(librarydiff.NOVALUE)
+        else:
+            nsValues.append(encodeColumn([globals()[nsName]], isString)[0])
+
+    return columns.diff(nsValues)
+
+def updateLibrary(
+    record,	# existing LibraryRecord
+    changed,	# bitmask of the changed columns of the library (see diffLibraries())
+    accessions	# current ACC_Accession rows of the library (list of dictionaries)
+    ):
+    # Purpose: creates sql to update the Clone Library record with the new values
+    # Returns: nothing
+    # Assumes: nothing
+    # Effects: appends to the record's cmds
+    # Throws: nothing
+
+    setCmds = []
+
+    #  for each attribute whose value has changed, update it.
+    #  (diffLibraries() does not count a new value of Not Specified as a change;
+    #  we don't want to overwrite a value w/ "Not Specified".)
+
+    for i in librarydiff.changedColumns(changed):
+
+        colName, attribute, nsName, isString = libColumns[i]
+        value = getattr(record, attribute)
+
+        record.changes.append(colName)
+
+        if isString:
+            setCmds.append('%s = "%s"' % (colName, value))
+        else:
+            setCmds.append('%s = %s' % (colName, value))
+
+        if colName == 'age':
+            setCmds.append('ageMin = %s' % (record.ageMin))
+            setCmds.append('ageMax = %s' % (record.ageMax))
+
+    # if there were any attribute value changes, then execute the update
+
+    if len(setCmds) > 0:
+        diagFile.write('Updating Library...%s.\n' % (record.libraryName))
+        setCmds.append('_ModifiedBy_key = %s' % (record.createdByKey))
+        setCmds.append('modification_date = getdate()')
+        setCmd = string.join(setCmds, ',')
+        record.cmds.append('update %s set %s where _Source_key = %s' % (libraryTable, setCmd, record.libraryKey))
+
+    # if accession id has changed, update it
+
+    if fieldMask.has_key('accessions') and len(record.libraryID) > 0:
+        for r in accessions:
+            if r['_LogicalDB_key'] == record.logicalDBKey and r['accID'] != record.libraryID:
+                record.cmds.append('exec ACC_update 1001,%s,"%s"' % (r['_Accession_key'], record.libraryID))
+
+    return
+
+def addCloneCollections(
+    records	# list of LibraryRecords
+    ):
+    # Purpose: creates sql for the Clone Collections of a batch of libraries
+    # Returns: nothing
+    # Assumes: nothing
+    # Effects: appends to each record's cmds
+    # Throws: nothing
+
+    global nextMemberKey
+
+    if len(records) == 0:
+        return
+
+    if nextMemberKey == 0:
+        results = db.sql('select maxKey = max(_SetMember_key) + 1 from %s' % (memberTable), 'auto')
+        nextMemberKey = results[0]['maxKey']
+
+    memberKey = nextMemberKey
+    seqNums = nextSeqNums
+
+    for record in records:
+
+        diagFile.write('Adding Clone Collections...%s, Library = %s.\n' % (record.cloneCollections, record.libraryName))
+
+        # delete existing clone collections for this library
+
+        record.cmds.append('delete MGI_SetMember from MGI_Set s, MGI_SetMember sm ' + \
+	    'where s._MGIType_key = %s ' % (MGITYPEKEY) + \
+	    'and s._Set_key = sm._Set_key ' + \
+	    'and sm._Object_key = %s' % (record.libraryKey))
+
+        for c in string.split(record.cloneCollections, '|'):
+
+            setKey = verifySet(c)
+
+            if setKey == 0:
+                noteInvalid('Set', c, record.lineNum)
+                continue
+
+            if not seqNums.has_key(setKey):
+                seqNums[setKey] = db.sql('select maxSeq = max(sequenceNum) + 1 from %s where _Set_key = %s' \
+		    % (memberTable, setKey), 'auto')[0]['maxSeq']
+
+            record.setKeys.append(setKey)
+
+            # write Member record
+            record.cmds.append('insert into %s values(%s,%s,%s,%d,%s,%s,"%s","%s") ' \
+		% (memberTable, memberKey, setKey, record.libraryKey, seqNums[setKey], \
+		record.createdByKey, record.createdByKey, loaddate, loaddate))
+
+            memberKey = memberKey + 1
+            seqNums[setKey] = seqNums[setKey] + 1
+
+    nextMemberKey = memberKey
+
+    return
+
+def verifySet(
+    name	# MGI_Set.name (string)
+    ):
+    # Purpose: verify a clone collection, consulting the set cache first
+    # Returns: the _Set_key of the collection, or 0 if it is invalid
+    # Assumes: nothing
+    # Effects: caches the key of each collection looked up
+    # Throws: nothing
+
+    if setCache.has_key(name):
+        return setCache[name]
+
+    setKey = 0
+    results = db.sql('select _Set_key from %s where name = "%s"' % (setTable, name), 'auto')
+    for r in results:
+        setKey = r['_Set_key']
+
+    setCache[name] = setKey
+
+    return setKey
+
+def writeRecords(
+    records	# list of LibraryRecords
+    ):
+    # Purpose: executes the sql created for a batch of libraries
+    #          if commitSize is set, the libraries are written in transactions
+    #          of commitSize libraries, each library within its own savepoint;
+    #          a library which fails is rolled back to its savepoint and reported
+    #          in the error file, and the rest of the transaction is kept.
+    #          the last transaction of the batch is committed here, so no
+    #          transaction holds its locks while the next batch is verified
+    #          (see adjustCommitSize() for how commitSize may change)
+    # Returns: nothing
+    # Assumes: nothing
+    # Effects: modifies the database unless in preview mode
+    # Throws: nothing
+
+    global uncommitted, inTransaction, transactionStart
+
+    if planFile is not None:
+        writePlan(records)
+
+    if commitSize <= 0 or DEBUG:
+        for record in records:
+            for cmd in record.cmds:
+                if DEBUG:
+                    db.sql(cmd, None, execute = 0)
+                else:
+                    countTableChange(executeChange(cmd))
+            countWritten(record)
+            record.cmds = []
+        return
+
+    for record in records:
+
+        if not inTransaction:
+            db.sql('begin transaction', None)
+            inTransaction = 1
+            transactionStart = time.time()
+
+        db.sql('save transaction %s' % (SAVEPOINT), None)
+
+        try:
+            changes = map(executeChange, record.cmds)
+            for change in changes:
+                countTableChange(change)
+            countWritten(record)
+        except:
+            db.sql('rollback transaction %s' % (SAVEPOINT), None)
+            errorFile.write('Could not load Library (line: %d): %s\n%s\n' \
+		% (record.lineNum, record.libraryName, sys.exc_info()[1]))
+            countMetric('errored')
+
+        record.cmds = []
+        uncommitted = uncommitted + 1
+
+        if uncommitted >= commitSize:
+            commitTransaction()
+
+    commitTransaction()
+
+    return
+
+def planGuard(
+    sourceKeys,	# _Source_keys of the libraries of the plan (list of integers)
+    setKeys	# _Set_keys of the clone collections the plan adds to (list of integers)
+    ):
+    # Purpose: read the state a plan depends on:
+    #          the highest key of the library and clone collection member tables
+    #          (the keys the plan adds), and the row count and a checksum of the
+    #          rows of the plan's libraries in PRB_Source, ACC_Accession and
+    #          MGI_SetMember and of the last sequenceNum of its clone collections,
+    #          so that edits, inserts and deletes of any of them are detected
+    # Returns: string
+    # Assumes: nothing
+    # Effects: nothing
+    # Throws: nothing
+
+    guard = []
+
+    for table, key in [(libraryTable, '_Source_key'), (memberTable, '_SetMember_key')]:
+        r = db.sql('select maxKey = max(%s) from %s' % (key, table), 'auto')[0]
+        guard.append('%s:%s' % (table, r['maxKey']))
+
+    # name, query of an IN-list of keys, columns of each row
+
+    queries = [(libraryTable, sourceKeys,
+	'select _Source_key, name, isCuratorEdited, ' + \
+	'modDate = convert(varchar(30), modification_date, 109) from %s ' % (libraryTable) + \
+	'where _Source_key in (%s)',
+	['_Source_key', 'name', 'isCuratorEdited', 'modDate']),
+	('ACC_Accession', sourceKeys,
+	'select _Accession_key, _Object_key, _LogicalDB_key, accID, ' + \
+	'modDate = convert(varchar(30), modification_date, 109) from ACC_Accession ' + \
+	'where _MGIType_key = %s and _Object_key in (%%s)' % (MGITYPEKEY),
+	['_Accession_key', '_Object_key', '_LogicalDB_key', 'accID', 'modDate']),
+	(memberTable, sourceKeys,
+	'select sm._SetMember_key, sm._Set_key, sm._Object_key, sm.sequenceNum ' + \
+	'from %s s, %s sm ' % (setTable, memberTable) + \
+	'where s._MGIType_key = %s and s._Set_key = sm._Set_key and sm._Object_key in (%%s)' % (MGITYPEKEY),
+	['_SetMember_key', '_Set_key', '_Object_key', 'sequenceNum']),
+	(setTable, setKeys,
+	'select _Set_key, maxSeq = max(sequenceNum) from %s where _Set_key in (%%s) group by _Set_key' % (memberTable),
+	['_Set_key', 'maxSeq'])]
+
+    for name, keys, query, columns in queries:
+        rows = []
+        for i in range(0, len(keys), MAXINLIST):
+            for r in db.sql(query % (string.join(map(str, keys[i:i + MAXINLIST]), ',')), 'auto'):
+                rows.append(string.join(map(lambda c: str(r[c]), columns), '|'))
+        rows.sort()
+        guard.append('%s:%d:%s' % (name, len(rows), hashlib.md5(string.join(rows, CRT)).hexdigest()))
+
+    return string.join(guard, ';')
+
+def writePlan(
+    records	# list of LibraryRecords
+    ):
+    # Purpose: write the changes of a batch of libraries to the plan file:
+    #	   library	line	add|update|unchanged	_Source_key	name	changed columns	_Set_keys
+    #	   sql		statement
+    #	   ...
+    # Returns: nothing
+    # Assumes: planFile is open
+    # Effects: writes to the plan file
+    # Throws: nothing
+
+    for record in records:
+
+        planSourceKeys[record.libraryKey] = 1
+        for setKey in record.setKeys:
+            planSetKeys[setKey] = 1
+
+        planFile.write(string.join(['library', str(record.lineNum), recordAction(record), str(record.libraryKey), \
+	    record.libraryName, string.join(record.changes, ','), string.join(map(str, record.setKeys), ',')], TAB) + CRT)
+
+        for cmd in record.cmds:
+            planFile.write('sql' + TAB + cmd + CRT)
+
+    return
+
+def finishPlan():
+    # Purpose: write the staleness guard of the plan (see planGuard()) as its last line;
+    #          a plan without it is incomplete and is refused by applyPlan()
+    # Returns: nothing
+    # Assumes: planFile is open
+    # Effects: writes to the plan file
+    # Throws: nothing
+
+    sourceKeys = planSourceKeys.keys()
+    sourceKeys.sort()
+    setKeys = planSetKeys.keys()
+    setKeys.sort()
+
+    planFile.write('#guard' + TAB + planGuard(sourceKeys, setKeys) + CRT)
+
+    return
+
+def applyPlan():
+    # Purpose: execute the plan file written by a preview run
+    # Returns: nothing
+    # Assumes: nothing
+    # Effects: modifies the database
+    #          exits with status 1 if the plan is stale or cannot be read
+    # Throws: nothing
+
+    try:
+        fp = open(planFileName, 'r')
+    except:
+        exit(1, 'Could not open file %s\n' % planFileName)
+
+    lines = fp.readlines()
+    fp.close()
+
+    if len(lines) == 0 or lines[-1][:7] != '#guard' + TAB:
+        exit(1, 'Invalid Plan File (incomplete): %s\n' % (planFileName))
+
+    sourceKeys = {}
+    setKeys = {}
+    for line in lines:
+        fields = string.split(line[:-1], TAB)
+        if fields[0] == 'library' and len(fields) > 3:
+            sourceKeys[int(fields[3])] = 1
+            if len(fields) > 6 and len(fields[6]) > 0:
+                for setKey in string.split(fields[6], ','):
+                    setKeys[int(setKey)] = 1
+
+    sourceKeys = sourceKeys.keys()
+    sourceKeys.sort()
+    setKeys = setKeys.keys()
+    setKeys.sort()
+
+    guard = planGuard(sourceKeys, setKeys)
+    if lines[-1][7:-1] != guard:
+        exit(1, 'Plan %s is stale: the database has changed since it was written\n' % (planFileName) + \
+	    'plan:     %s\ndatabase: %s\n' % (lines[-1][7:-1], guard))
+
+    global linesDone, linesTotal, rowsRead
+
+    diagFile.write('Applying Plan: %s\n' % (planFileName))
+
+    startTime = startPhase('apply')
+    linesTotal = len(filter(lambda line: line[:8] == 'library' + TAB, lines))
+    batch = []
+    record = None
+
+    for line in lines[:-1]:
+
+        tokens = string.split(line[:-1], TAB, 1)
+
+        if tokens[0] == 'library':
+            fields = string.split(tokens[1], TAB)
+            if record is not None:
+                batch.append(record)
+            record = LibraryRecord(int(fields[0]))
+            record.libraryKey = int(fields[2])
+            record.libraryName = fields[3]
+            record.isNew = fields[1] == 'add'
+            if len(fields) > 4 and len(fields[4]) > 0:
+                record.changes = string.split(fields[4], ',')
+            if len(fields) > 5 and len(fields[5]) > 0:
+                record.setKeys = string.split(fields[5], ',')
+            diagFile.write('Applying Library...%s (%s).\n' % (record.libraryName, fields[1]))
+            linesDone = linesDone + 1
+            rowsRead = rowsRead + 1
+            writeStatus(0)
+            countMetric('rows_read')
+        elif tokens[0] == 'sql' and record is not None:
+            record.cmds.append(tokens[1])
+
+        if len(batch) >= batchSize:
+            writeRecords(batch)
+            batch = []
+
+    if record is not None:
+        batch.append(record)
+
+    writeRecords(batch)
+    commitTransaction()
+    timePhase('apply', startTime)
+
+    return
+
+def checkQueryBudget():
+    # Purpose: report the number of database calls per input row
+    # Returns: nothing
+    # Assumes: nothing
+    # Effects: writes to stdout
+    #          exits with status 1 if queryBudget is set and exceeded
+    # Throws: nothing
+
+    if rowsRead > 0:
+        perRow = float(dbreplay.sqlCount) / rowsRead
+    else:
+        perRow = 0.0
+
+    sys.stdout.write('Database Calls: %d\nInput Rows: %d\nDatabase Calls per Row: %.2f\n' \
+	% (dbreplay.sqlCount, rowsRead, perRow))
+
+    if queryBudget and perRow > float(queryBudget):
+        exit(1, 'Query budget exceeded: %.2f database calls per row (budget %s)\n' % (perRow, queryBudget))
+
+    return
+
+def executeChange(
+    cmd		# sql statement (string)
+    ):
+    # Purpose: execute a statement and find the table and number of rows it changed:
+    #          a delete reads @@rowcount in the same batch (it may remove
+    #          no row or many); each insert or update (by key) changes one row
+    #          of its table, as does each ACC_insert or ACC_update
+    # Returns: tuple (table, rows); table is None for other statements
+    # Assumes: nothing
+    # Effects: modifies the database
+    # Throws: the exception of the statement
+
+    words = string.split(cmd, None, 3)
+
+    if len(words) < 2:
+        table = None
+    elif words[0] == 'exec' and words[1] in ['ACC_insert', 'ACC_update']:
+        table = 'ACC_Accession'
+    elif words[0] in ['insert', 'update', 'delete']:
+        table = words[1]
+        if table == 'into' and len(words) > 2:
+            table = words[2]
+        table = string.split(table, '(')[0]
+    else:
+        table = None
+
+    if table is not None and words[0] == 'delete':
+        results = db.sql(cmd + CRT + 'select rows = @@rowcount', 'auto')
+        if results:
+            return (table, results[0]['rows'])
+        return (table, 0)
+
+    db.sql(cmd, None)
+
+    return (table, 1)
+
+def countTableChange(
+    change	# tuple (table, rows) of an executed statement (see executeChange())
+    ):
+    # Purpose: count the rows changed by an executed statement, by table
+    # Returns: nothing
+    # Assumes: nothing
+    # Effects: updates tableChanges
+    # Throws: nothing
+
+    table, rows = change
+
+    if table is not None:
+        tableChanges[table] = tableChanges.get(table, 0) + rows
+
+    return
+
+def refreshStatistics():
+    # Purpose: update the statistics of each table whose rows changed by this run
+    #          are at least statsThreshold of its rows; report each decision
+    #          and the time the update took
+    # Returns: nothing
+    # Assumes: nothing
+    # Effects: updates table statistics; writes to stdout (the run log)
+    # Throws: nothing
+
+    if statsThreshold <= 0 or DEBUG or shardIndex is not None:
+        return
+
+    tables = tableChanges.keys()
+    tables.sort()
+
+    for table in tables:
+
+        rows = db.sql('select rows = row_count(db_id(), object_id("%s"))' % (table), 'auto')[0]['rows']
+        if rows > 0:
+            fraction = float(tableChanges[table]) / rows
+        else:
+            fraction = 1.0
+
+        if fraction < statsThreshold:
+            sys.stdout.write('Statistics (%s): %d of %d rows changed (%.3f); not updated\n' \
+		% (table, tableChanges[table], rows, fraction))
+            continue
+
+        startTime = time.time()
+        try:
+            db.sql('update statistics %s' % (table), None)
+        except:
+            sys.stdout.write('Statistics (%s): could not be updated: %s\n' % (table, sys.exc_info()[1]))
+            continue
+
+        sys.stdout.write('Statistics (%s): %d of %d rows changed (%.3f); updated in %.3f seconds\n' \
+	    % (table, tableChanges[table], rows, fraction, time.time() - startTime))
+
+        # the daemon counts again from here
+        del tableChanges[table]
+
+    return
+
+def commitTransaction():
+    # Purpose: commits the open transaction, if any
+    # Returns: nothing
+    # Assumes: nothing
+    # Effects: modifies the database
+    # Throws: nothing
+
+    global uncommitted, inTransaction
+
+    if inTransaction:
+        db.sql('commit transaction', None)
+        commitSizes[commitSize] = commitSizes.get(commitSize, 0) + 1
+        adjustCommitSize(time.time() - transactionStart, uncommitted)
+
+    uncommitted = 0
+    inTransaction = 0
+
+    return
+
+def adjustCommitSize(
+    elapsed,	# seconds from begin to end of commit of the last transaction:
+		# its statements and the commit only (see writeRecords()) (float)
+    libraries	# number of libraries written in the last transaction (integer)
+    ):
+    # Purpose: adapt the commit size to the time transactions take:
+    #          halve it when a transaction takes longer than commitTarget
+    #          (it holds its locks too long for other users of the database),
+    #          grow it by half when a full transaction takes less than half of commitTarget;
+    #          always within commitMin and commitMax
+    # Returns: nothing
+    # Assumes: nothing
+    # Effects: sets commitSize; logs each change in the diagnostics file
+    # Throws: nothing
+
+    global commitSize
+
+    if commitMax <= 0:
+        return
+
+    newSize = commitSize
+
+    if elapsed > commitTarget:
+        newSize = max(commitMin, commitSize / 2)
+    elif elapsed < commitTarget / 2 and libraries >= commitSize:
+        newSize = min(commitMax, commitSize + max(1, commitSize / 2))
+
+    if newSize != commitSize:
+        diagFile.write('Commit Size: %d -> %d (%d libraries committed in %.2f seconds; target %.2f)\n' \
+	    % (commitSize, newSize, libraries, elapsed, commitTarget))
+        commitSize = newSize
+
+    return
+
+def reportCommitSizes():
+    # Purpose: report the commit sizes used, and the number of transactions of each
+    # Returns: nothing
+    # Assumes: nothing
+    # Effects: writes to stdout
+    # Throws: nothing
+
+    if len(commitSizes) == 0:
+        return
+
+    sizes = commitSizes.keys()
+    sizes.sort()
+
+    sys.stdout.write('Commit Sizes: %s\n' \
+	% (string.join(map(lambda s: '%d (%d transactions)' % (s, commitSizes[s]), sizes), ', ')))
+
+    return
+
+def countMetric(
+    name,	# metric name (see metricsCounters)
+    value = 1	# amount to add (number)
+    ):
+    # Purpose: add to a metric of the current input file
+    # Returns: nothing
+    # Assumes: nothing
+    # Effects: updates fileMetrics
+    # Throws: nothing
+
+    if not fileMetrics.has_key(inputFileName):
+        fileMetrics[inputFileName] = {}
+
+    metrics = fileMetrics[inputFileName]
+    metrics[name] = metrics.get(name, 0) + value
+
+    return
+
+def timePhase(
+    phase,	# phase name (string)
+    startTime	# time the phase started (float)
+    ):
+    # Purpose: add the time since startTime to a phase of the current input file
+    # Returns: nothing
+    # Assumes: nothing
+    # Effects: updates filePhases
+    # Throws: nothing
+
+    if not filePhases.has_key(inputFileName):
+        filePhases[inputFileName] = {}
+
+    phases = filePhases[inputFileName]
+    phases[phase] = phases.get(phase, 0.0) + time.time() - startTime
+
+    return
+
+def recordAction(
+    record	# LibraryRecord
+    ):
+    # Purpose: the action taken for a library
+    # Returns: 'add', 'update' or 'unchanged'
+    # Assumes: the record's sql has been created
+    # Effects: nothing
+    # Throws: nothing
+
+    if record.isNew:
+        return 'add'
+    elif len(record.changes) > 0:
+        return 'update'
+
+    return 'unchanged'
+
+def countWritten(
+    record	# LibraryRecord
+    ):
+    # Purpose: count the action taken for a library, and its clone collection
+    #          members, once its sql has been executed
+    # Returns: nothing
+    # Assumes: nothing
+    # Effects: updates the metrics of the current input file
+    # Throws: nothing
+
+    countMetric(actionMetrics[recordAction(record)])
+    countMetric('set_members', len(record.setKeys))
+
+    return
+
+def mergeShardMetrics(
+    fileName	# metrics file of a shard worker (string)
+    ):
+    # Purpose: add the metrics of a shard worker to the metrics of the current input file;
+    #          phase times are summed over the workers
+    # Returns: nothing
+    # Assumes: the worker loaded the current input file
+    # Effects: updates fileMetrics and filePhases; removes the worker's metrics file
+    # Throws: nothing
+
+    try:
+        fp = open(fileName, 'r')
+    except:
+        return
+
+    if not filePhases.has_key(inputFileName):
+        filePhases[inputFileName] = {}
+
+    for line in fp.readlines():
+        match = re.match(r'libraryload_(\w+)\{(.*)\} (\S+)$', line)
+        if match is None:
+            continue
+        name, labels, value = match.groups()
+        if name == 'phase_seconds':
+            phase = re.search(r'phase="([^"]*)"', labels)
+            if phase is not None:
+                phases = filePhases[inputFileName]
+                phases[phase.group(1)] = phases.get(phase.group(1), 0.0) + float(value)
+        elif name in map(lambda c: c[0], metricsCounters) and name != 'seconds':
+            countMetric(name, int(value))
+
+    fp.close()
+    os.remove(fileName)
+
+    return
+
+def writeMetrics(
+    status	# exit status of this run (integer)
+    ):
+    # Purpose: write the metrics of this run in node_exporter textfile format:
+    #          the counts, database calls, phase times and rows per second of
+    #          each input file, and the time and exit status of the run.
+    #          a shard worker writes LIBRARYMETRICSFILE.shardN, which its
+    #          coordinator merges (see mergeShardMetrics())
+    # Returns: nothing
+    # Assumes: nothing
+    # Effects: replaces the metrics file, atomically
+    # Throws: IOError, OSError if the file cannot be written
+
+    if not metricsFileName:
+        return
+
+    fileName = metricsFileName
+    if shardIndex is not None:
+        fileName = fileName + '.shard%d' % (shardIndex)
+
+    def escape(value):
+        return string.replace(string.replace(string.replace(value, '\\', '\\\\'), '"', '\\"'), CRT, '\\n')
+
+    def labels(fileName = None, phase = None):
+        l = ['provider="%s"' % (escape(provider))]
+        if fileName is not None:
+            l.append('input_file="%s"' % (escape(fileName)))
+        if phase is not None:
+            l.append('phase="%s"' % (escape(phase)))
+        return '{' + string.join(l, ',') + '}'
+
+    def metric(name, description):
+        return ['# HELP libraryload_%s %s' % (name, description), '# TYPE libraryload_%s gauge' % (name)]
+
+    files = filter(lambda f: fileMetrics.has_key(f) or filePhases.has_key(f), inputFileNames)
+    lines = []
+
+    for name, description in metricsCounters:
+        lines = lines + metric(name, description)
+        for f in files:
+            value = fileMetrics.get(f, {}).get(name, 0)
+            if type(value) == type(0.0):
+                value = '%.3f' % (value)
+            lines.append('libraryload_%s%s %s' % (name, labels(f), value))
+
+    lines = lines + metric('phase_seconds', 'Wall time of each phase')
+    for f in files:
+        phases = filePhases.get(f, {})
+        names = phases.keys()
+        names.sort()
+        for phase in names:
+            lines.append('libraryload_phase_seconds%s %.3f' % (labels(f, phase), phases[phase]))
+
+    lines = lines + metric('rows_per_second', 'Input rows read per second of wall time')
+    for f in files:
+        metrics = fileMetrics.get(f, {})
+        if metrics.get('seconds', 0) > 0:
+            lines.append('libraryload_rows_per_second%s %.3f' \
+		% (labels(f), metrics.get('rows_read', 0) / metrics['seconds']))
+
+    lines = lines + metric('run_seconds', 'Wall time of the run')
+    lines.append('libraryload_run_seconds%s %.3f' % (labels(), time.time() - runStart))
+    lines = lines + metric('exit_status', 'Exit status of the run')
+    lines.append('libraryload_exit_status%s %d' % (labels(), status))
+    lines = lines + metric('last_run_timestamp_seconds', 'End time of the run')
+    lines.append('libraryload_last_run_timestamp_seconds%s %d' % (labels(), time.time()))
+
+    fp = open(fileName + '.new', 'w')
+    fp.write(string.join(lines, CRT) + CRT)
+    fp.close()
+    os.rename(fileName + '.new', fileName)
+
+    return
+
+def startPhase(
+    phase	# phase name (string)
+    ):
+    # Purpose: record the start of a phase of the current input file
+    # Returns: the current time (float)
+    # Assumes: nothing
+    # Effects: sets currentPhase and resets the progress; writes the status file
+    # Throws: nothing
+
+    global currentPhase, linesDone, linesTotal, phaseStart
+
+    currentPhase = phase
+    linesDone = 0
+    linesTotal = 0
+    phaseStart = time.time()
+    writeStatus(1)
+
+    return phaseStart
+
+def statusLines():
+    # Purpose: the current status: phase, progress, rate, estimated time
+    #          remaining and the counters of the current input file
+    # Returns: list of 'name: value' strings
+    # Assumes: nothing
+    # Effects: nothing
+    # Throws: nothing
+
+    now = time.time()
+    elapsed = now - phaseStart
+
+    lines = ['pid: %d' % (os.getpid()),
+	'updated: %s' % (time.ctime(now)),
+	'phase: %s' % (currentPhase),
+	'input file: %s (%d of %d)' % (inputFileName, min(filesProcessed + 1, len(inputFileNames)), len(inputFileNames))]
+
+    if shardIndex is not None:
+        lines.append('shard: %d of %d' % (shardIndex, shardCount))
+
+    lines.append('line: %d of %d' % (linesDone, linesTotal))
+
+    if linesDone > 0 and elapsed > 0:
+        rate = linesDone / elapsed
+        lines.append('rows per second: %.1f' % (rate))
+        lines.append('eta seconds: %d' % ((linesTotal - linesDone) / rate))
+
+    lines.append('elapsed seconds: %d' % (now - runStart))
+    lines.append('database calls: %d' % (dbreplay.sqlCount))
+
+    metrics = fileMetrics.get(inputFileName, {})
+    for name, description in metricsCounters:
+        if type(metrics.get(name)) == type(0.0):
+            lines.append('%s: %.3f' % (name, metrics[name]))
+        elif metrics.has_key(name):
+            lines.append('%s: %s' % (name, metrics[name]))
+
+    phases = filePhases.get(inputFileName, {})
+    names = phases.keys()
+    names.sort()
+    for phase in names:
+        lines.append('%s seconds: %.3f' % (phase, phases[phase]))
+
+    return lines
+
+def writeStatus(
+    force	# true to write even if statusInterval has not passed (boolean)
+    ):
+    # Purpose: rewrite the status file, at most once per statusInterval
+    # Returns: nothing
+    # Assumes: nothing
+    # Effects: replaces the status file, atomically
+    # Throws: nothing
+
+    global lastStatus
+
+    if not statusFileName:
+        return
+
+    now = time.time()
+    if not force and now - lastStatus < statusInterval:
+        return
+
+    lastStatus = now
+
+    fileName = statusFileName
+    if shardIndex is not None:
+        fileName = fileName + '.shard%d' % (shardIndex)
+
+    try:
+        fp = open(fileName + '.new', 'w')
+        fp.write(string.join(statusLines(), CRT) + CRT)
+        fp.close()
+        os.rename(fileName + '.new', fileName)
+    except:
+        pass
+
+    return
+
+def dumpStats(
+    signum,	# signal number
+    frame	# current stack frame
+    ):
+    # Purpose: SIGUSR1 handler: write the current status and all in-memory
+    #          statistics (every input file, caches, commit sizes) to stderr
+    # Returns: nothing
+    # Assumes: nothing
+    # Effects: writes to stderr
+    # Throws: nothing
+
+    lines = ['--- libraryload statistics ---'] + statusLines()
+
+    lines.append('rows read: %d' % (rowsRead))
+    lines.append('vocabulary cache: %d terms' % (len(vocabCache)))
+    lines.append('invalid value cache: %d values' % (len(invalidCache)))
+    lines.append('age cache: %d ages' % (len(ageCache)))
+    lines.append('set cache: %d sets' % (len(setCache)))
+    lines.append('commit size: %d' % (commitSize))
+
+    sizes = commitSizes.keys()
+    sizes.sort()
+    for size in sizes:
+        lines.append('transactions of %d: %d' % (size, commitSizes[size]))
+
+    for f in inputFileNames:
+        if not fileMetrics.has_key(f):
+            continue
+        metrics = fileMetrics[f]
+        names = metrics.keys()
+        names.sort()
+        lines.append('%s: %s' % (f, string.join(map(lambda n: '%s=%s' % (n, metrics[n]), names), ', ')))
+
+    lines.append('---')
+
+    sys.stderr.write(string.join(lines, CRT) + CRT)
+    sys.stderr.flush()
+
+    return
+
+def stopWatching(
+    signum,	# signal number
+    frame	# current stack frame
+    ):
+    # Purpose: SIGTERM/SIGINT handler of the daemon: stop once
+    #          the file in progress (if any) has been loaded
+    # Returns: nothing
+    # Assumes: nothing
+    # Effects: sets stopping
+    # Throws: nothing
+
+    global stopping
+
+    stopping = 1
+    sys.stderr.write('Signal %d: stopping after the file in progress\n' % (signum))
+
+    return
+
+def clearCaches():
+    # Purpose: empty the lookup caches, so that vocabulary terms, ages and
+    #          clone collections are looked up again
+    # Returns: nothing
+    # Assumes: nothing
+    # Effects: empties vocabCache, invalidCache, ageCache, setCache
+    # Throws: nothing
+
+    if len(vocabCache) + len(invalidCache) + len(ageCache) + len(setCache) == 0:
+        return
+
+    sys.stdout.write('%s: clearing caches (%d terms, %d invalid values, %d ages, %d sets)\n' \
+	% (mgi_utils.date(), len(vocabCache), len(invalidCache), len(ageCache), len(setCache)))
+
+    vocabCache.clear()
+    invalidCache.clear()
+    ageCache.clear()
+    setCache.clear()
+
+    return
+
+def watchFiles():
+    # Purpose: daemon: poll watchDirName every watchInterval seconds and load each
+    #          file whose size and modification time have not changed since the
+    #          previous poll (files whose names begin with '.' are ignored, so a
+    #          provider may write to a hidden name and rename it);
+    #          the caches are emptied every cacheInterval seconds
+    # Returns: nothing, once stopWatching() has been called
+    # Assumes: init() has created the done/ and failed/ subdirectories
+    # Effects: loads files; moves them out of watchDirName
+    # Throws: nothing
+
+    seen = {}		# file name -> (size, modification time) at the previous poll
+    unmoved = {}	# file name -> (size, modification time) of a loaded file which could not be moved
+    cacheTime = time.time()
+
+    sys.stdout.write('%s: watching %s every %s seconds\n' % (mgi_utils.date(), watchDirName, watchInterval))
+    sys.stdout.flush()
+    startPhase('idle')
+
+    while not stopping:
+
+        if cacheInterval > 0 and time.time() - cacheTime >= cacheInterval:
+            clearCaches()
+            cacheTime = time.time()
+
+        names = os.listdir(watchDirName)
+        names.sort()
+
+        current = {}
+        ready = []
+
+        for name in names:
+            fileName = os.path.join(watchDirName, name)
+            if name[0] == '.' or not os.path.isfile(fileName):
+                continue
+            try:
+                current[fileName] = (os.path.getsize(fileName), os.path.getmtime(fileName))
+            except OSError:
+                continue
+            if unmoved.get(fileName) == current[fileName]:
+                continue
+            if seen.get(fileName) == current[fileName]:
+                ready.append(fileName)
+
+        seen = current
+
+        for fileName in ready:
+            if stopping:
+                break
+            if not loadWatchedFile(fileName):
+                unmoved[fileName] = seen[fileName]
+            del seen[fileName]
+            startPhase('idle')
+
+        if len(ready) == 0 and not stopping:
+            time.sleep(watchInterval)
+
+    return
+
+def loadWatchedFile(
+    fileName	# input file name (string)
+    ):
+    # Purpose: daemon: load one input file, with the connection and caches of
+    #          the files before it, then move it to the done/ or failed/
+    #          subdirectory of watchDirName (by rename, so it is never seen
+    #          half-moved); a file which fails does not stop the daemon
+    # Returns: 1 if the file was moved, else 0 (it is not loaded again unless it changes)
+    # Assumes: nothing
+    # Effects: modifies the database unless in preview mode;
+    #          rewrites the metrics file for this file
+    # Throws: nothing
+
+    global inputFileNames, nextLibraryKey, nextMemberKey
+
+    inputFileNames = [fileName]
+    fileMetrics.clear()
+    filePhases.clear()
+
+    # other loads and curators may have added keys since the previous file
+
+    nextLibraryKey = 0
+    nextMemberKey = 0
+    nextSeqNums.clear()
+
+    status = loadFile(fileName)
+    refreshStatistics()
+
+    try:
+        saveVocabCache()
+    except:
+        pass
+
+    try:
+        writeMetrics(status)
+    except:
+        sys.stderr.write('Could not write file %s\n' % metricsFileName)
+
+    if status == 0:
+        target = os.path.join(watchDirName, 'done', os.path.basename(fileName))
+    else:
+        target = os.path.join(watchDirName, 'failed', os.path.basename(fileName))
+
+    # never replace an earlier file of the same name
+
+    name = target
+    i = 0
+    while os.path.exists(target):
+        i = i + 1
+        target = '%s.%s.%d.%d' % (name, time.strftime('%Y%m%d%H%M%S'), os.getpid(), i)
+
+    try:
+        os.rename(fileName, target)
+    except OSError, message:
+        sys.stderr.write('%s: could not move %s to %s: %s\n' % (mgi_utils.date(), fileName, target, message))
+        return 0
+
+    sys.stdout.write('%s: %s -> %s\n' % (mgi_utils.date(), fileName, target))
+    sys.stdout.flush()
+
+    return 1
+
+#
+# Main
+#
+
+init()
+verifyMode()
+
+# a replayed run stops at the first query which is not in the trace
+
+try:
+    if watchDirName and shardIndex is None:
+        watchFiles()
+    elif mode == 'apply':
+        openFiles(inputFileNames[0])
+        applyPlan()
+        refreshStatistics()
+    else:
+        for f in inputFileNames:
+            filesFailed = filesFailed + loadFile(f)
+
+        # a plan of a preview that failed is left incomplete, so it cannot be applied
+
+        if planFile is not None and filesFailed == 0:
+            finishPlan()
+
+        # the rows changed by the files which were loaded count, whether or not the others were
+        refreshStatistics()
+except dbreplay.ReplayError, message:
+    exit(1, 'Could not replay %s: %s\n' % (dbReplayFileName, message))
+
+reportCommitSizes()
+checkQueryBudget()
+
+if filesFailed > 0:
+    exit(1, '%d of %d input files could not be loaded\n' % (filesFailed, len(inputFileNames)))
 
-init()
-verifyMode()
-processFile()
 exit(0)
 
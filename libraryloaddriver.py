@@ -0,0 +1,311 @@
+#!/usr/local/bin/python
+
+#
+# Program: libraryloaddriver.py
+#
+# Purpose:
+#
+#	To parse and load the library files of several providers
+#	(IMAGE, NIA, ...) in one cycle.
+#
+#	The parse stages of all providers run concurrently.
+#	Each provider's load stage starts as soon as its parse stage is done;
+#	the number of loads writing to the database at the same time is limited,
+#	and all loads share one vocabulary cache (LIBRARYVOCABCACHE),
+#	so a term verified by one provider's load is not looked up again by the next.
+#
+# Usage:
+#	libraryloaddriver.py [-p parse concurrency] [-w load concurrency]
+#			     [-S summary file] config file...
+#
+#	-p number of parse stages to run at once (default: all)
+#	-w number of load stages to run at once (default: 1)
+#	-S write the timing summary to this file (default: stdout)
+#
+# Envvars:
+#
+#	Each config file is a csh configuration file (see config.default) which sets:
+#
+#	LIBRARYLOAD		libraryload installation directory
+#	LIBRARYINPUTFILE	input file of libraryload.py
+#	LIBRARYLOG		log file of this provider
+#	LIBRARYPROVIDER		optional; provider name (default: config file name)
+#	LIBRARYPARSECMD		optional; parse command, e.g. "${LIBRARYLOAD}/imageparse.py -I image.txt"
+#	LIBRARYPARSEDIR		optional; directory the parse command is run in
+#				(default: directory of LIBRARYINPUTFILE)
+#
+# Outputs:
+#
+#	A log file per provider (LIBRARYLOG)
+#	A summary of the parse and load timings of each provider
+#
+# Exit Codes:
+#
+#       0 = successful
+#       1 = any provider failed
+#
+# Implementation:
+#
+#	Modules:
+#
+#	def showUsage():	prints usage of this program and exits
+#	def readConfig():	reads the environment set by a csh config file
+#	def runStage():		runs one stage of one provider, logging to its log file
+#	def runProvider():	runs the parse and load stages of one provider
+#	def writeSummary():	writes the timing summary
+#
+
+import sys
+import os
+import string
+import getopt
+import tempfile
+import threading
+import subprocess
+import time
+
+#globals
+
+TAB = '\t'
+CRT = '\n'
+
+parseConcurrency = 0	# 0 = all providers at once
+loadConcurrency = 1
+summaryFileName = ''
+
+results = []		# one dictionary per provider
+resultsLock = threading.Lock()
+
+def showUsage():
+    # Purpose: displays correct usage of this program
+    # Returns: nothing
+    # Assumes: nothing
+    # Effects: exits with status of 1
+    # Throws: nothing
+
+    sys.stderr.write('usage: %s [-p parse concurrency] [-w load concurrency] ' % sys.argv[0] + \
+	'[-S summary file] config file...\n')
+    sys.exit(1)
+
+def readConfig(
+    configFileName	# csh configuration file (string)
+    ):
+    # Purpose: source a csh configuration file and capture the resulting environment
+    # Returns: dictionary of environment variables
+    # Assumes: csh is available
+    # Effects: runs csh
+    # Throws: RuntimeError if the configuration file cannot be sourced
+
+    env = os.environ.copy()
+    env['CONFIGFILE'] = configFileName
+
+    try:
+        p = subprocess.Popen(['csh', '-f', '-c', 'source %s && env' % (configFileName)], \
+	    stdout = subprocess.PIPE, env = env)
+        output = p.communicate()[0]
+    except OSError, message:
+        raise RuntimeError('Could not source configuration file %s: %s' % (configFileName, message))
+
+    if p.returncode != 0:
+        raise RuntimeError('Could not source configuration file %s' % (configFileName))
+
+    config = {}
+    for line in string.split(output, CRT):
+        i = string.find(line, '=')
+        if i > 0:
+            config[line[:i]] = line[i + 1:]
+
+    return config
+
+def runStage(
+    args,	# command (string, run by the shell)
+    config,	# environment (dictionary)
+    cwd,	# working directory (string)
+    log		# log file descriptor
+    ):
+    # Purpose: run one stage of a provider
+    # Returns: (exit status, elapsed seconds)
+    # Assumes: nothing
+    # Effects: runs the command; appends its output to the log
+    # Throws: nothing
+
+    log.write('%s: %s\n' % (time.ctime(), args))
+    log.flush()
+
+    startTime = time.time()
+    status = subprocess.call(args, shell = True, cwd = cwd, env = config, \
+	stdout = log, stderr = subprocess.STDOUT)
+    elapsed = time.time() - startTime
+
+    log.write('%s: exit status %d, %.1f seconds\n' % (time.ctime(), status, elapsed))
+    log.flush()
+
+    return status, elapsed
+
+def runProvider(
+    configFileName,	# csh configuration file (string)
+    vocabCacheFileName,	# shared vocabulary cache file (string)
+    parseSemaphore,	# limits concurrent parse stages
+    loadSemaphore	# limits concurrent load stages
+    ):
+    # Purpose: run the parse and then the load stage of one provider
+    # Returns: nothing
+    # Assumes: nothing
+    # Effects: appends the provider's result to results, always
+    #          (status 1 if the provider could not be run)
+    # Throws: nothing
+
+    result = {'provider':os.path.basename(configFileName), 'config':configFileName,
+	'parse':None, 'load':None, 'status':1}
+
+    def addResult():
+        resultsLock.acquire()
+        results.append(result)
+        resultsLock.release()
+
+    try:
+        config = readConfig(configFileName)
+    except RuntimeError, message:
+        sys.stderr.write(str(message) + CRT)
+        addResult()
+        return
+
+    result['provider'] = config.get('LIBRARYPROVIDER', result['provider'])
+    config['LIBRARYVOCABCACHE'] = vocabCacheFileName
+
+    missing = filter(lambda v: not config.get(v), ['LIBRARYLOAD', 'LIBRARYINPUTFILE', 'LIBRARYLOG'])
+    if len(missing) > 0:
+        sys.stderr.write('%s does not set %s\n' % (configFileName, string.join(missing, ', ')))
+        addResult()
+        return
+
+    try:
+        log = open(config['LIBRARYLOG'], 'w')
+    except:
+        sys.stderr.write('Could not open file %s\n' % config['LIBRARYLOG'])
+        addResult()
+        return
+
+    log.write('Start Date/Time: %s\n' % (time.ctime()))
+
+    status = 1
+
+    try:
+        status = 0
+        inputDir = os.path.dirname(config['LIBRARYINPUTFILE']) or '.'
+
+        if config.get('LIBRARYPARSECMD'):
+            parseSemaphore.acquire()
+            try:
+                status, result['parse'] = runStage(config['LIBRARYPARSECMD'], config, \
+		    config.get('LIBRARYPARSEDIR', inputDir), log)
+            finally:
+                parseSemaphore.release()
+
+        if status == 0:
+            loadSemaphore.acquire()
+            try:
+                status, result['load'] = runStage(os.path.join(config['LIBRARYLOAD'], 'libraryload.py'), \
+		    config, inputDir, log)
+            finally:
+                loadSemaphore.release()
+    except:
+        status = 1
+        log.write('%s: could not run provider: %s\n' % (time.ctime(), sys.exc_info()[1]))
+
+    result['status'] = status
+
+    log.write('End Date/Time: %s\n' % (time.ctime()))
+    log.close()
+
+    addResult()
+
+    return
+
+def writeSummary(
+    fp,		# summary file descriptor
+    elapsed	# total elapsed seconds (float)
+    ):
+    # Purpose: write the timing summary of all providers
+    # Returns: nothing
+    # Assumes: nothing
+    # Effects: writes to fp
+    # Throws: nothing
+
+    def seconds(value):
+        if value is None:
+            return '-'
+        return '%.1f' % (value)
+
+    fp.write('provider' + TAB + 'parse' + TAB + 'load' + TAB + 'status' + CRT)
+    for r in results:
+        fp.write(r['provider'] + TAB + seconds(r['parse']) + TAB + \
+	    seconds(r['load']) + TAB + str(r['status']) + CRT)
+    fp.write('total' + TAB + TAB + seconds(elapsed) + CRT)
+
+    return
+
+#
+# Main
+#
+
+try:
+    optlist, configFileNames = getopt.getopt(sys.argv[1:], 'p:w:S:')
+except:
+    showUsage()
+
+try:
+    for opt in optlist:
+        if opt[0] == '-p':
+            parseConcurrency = string.atoi(opt[1])
+        elif opt[0] == '-w':
+            loadConcurrency = string.atoi(opt[1])
+        elif opt[0] == '-S':
+            summaryFileName = opt[1]
+except ValueError:
+    showUsage()
+
+if len(configFileNames) == 0 or loadConcurrency < 1 or parseConcurrency < 0:
+    showUsage()
+
+if parseConcurrency == 0:
+    parseConcurrency = len(configFileNames)
+
+fd, vocabCacheFileName = tempfile.mkstemp('.vocabcache')
+os.close(fd)
+os.remove(vocabCacheFileName)
+
+parseSemaphore = threading.Semaphore(parseConcurrency)
+loadSemaphore = threading.Semaphore(loadConcurrency)
+
+startTime = time.time()
+
+threads = []
+for configFileName in configFileNames:
+    t = threading.Thread(target = runProvider, \
+	args = (configFileName, vocabCacheFileName, parseSemaphore, loadSemaphore))
+    t.start()
+    threads.append(t)
+
+for t in threads:
+    t.join()
+
+results.sort(lambda x, y: cmp(configFileNames.index(x['config']), configFileNames.index(y['config'])))
+
+for f in [vocabCacheFileName, vocabCacheFileName + '.lock']:
+    if os.path.exists(f):
+        os.remove(f)
+
+if summaryFileName != '':
+    summaryFile = open(summaryFileName, 'w')
+    writeSummary(summaryFile, time.time() - startTime)
+    summaryFile.close()
+else:
+    writeSummary(sys.stdout, time.time() - startTime)
+
+for r in results:
+    if r['status'] != 0:
+        sys.exit(1)
+
+sys.exit(0)
+
@@ -0,0 +1,189 @@
+#!/usr/local/bin/python
+
+#
+# Program: libraryvocab.py
+#
+# Purpose:
+#
+#	Local MGI vocabulary snapshot used by imageparse.py and niaparse.py
+#	to reject rows that libraryload.py would not be able to load,
+#	before the parsed file ever reaches the database.
+#
+# Usage:
+#
+#	To write a snapshot of the current MGI vocabularies:
+#
+#	libraryvocab.py -O snapshot file
+#
+#	(requires MGD_DBUSER and MGD_DBPASSWORDFILE)
+#
+#	To validate parsed records:
+#
+#	import libraryvocab
+#	snapshot = libraryvocab.readSnapshot(fileName)
+#	errors = libraryvocab.validateRecord(snapshot, fields)
+#
+# Inputs/Outputs:
+#
+#	A snapshot is a tab-delimited file:
+#		field 1: Vocabulary (see vocabQueries)
+#		field 2: Term
+#
+#	Only the vocabularies present in a snapshot are validated.
+#
+# Exit Codes:
+#
+#       0 = successful
+#       1 = error
+#
+# Implementation:
+#
+#	Modules:
+#
+#	def readSnapshot():	reads a snapshot file
+#	def validateRecord():	validates a parsed (libraryload.py format) record
+#	def writeSnapshot():	writes a snapshot file from the database
+#
+
+import sys
+import os
+import string
+
+#globals
+
+TAB = '\t'
+CRT = '\n'
+
+# vocabulary name, query returning its terms as 'term'
+vocabQueries = [
+    ('Logical DB', 'select term = name from ACC_LogicalDB'),
+    ('Segment Type', 'select term = t.term from VOC_Term t, VOC_Vocab v ' + \
+	'where v.name = "Segment Type" and v._Vocab_key = t._Vocab_key'),
+    ('Vector Type', 'select term = t.term from VOC_Term t, VOC_Vocab v ' + \
+	'where v.name = "Segment Vector Type" and v._Vocab_key = t._Vocab_key'),
+    ('Organism', 'select term = commonName from MGI_Organism'),
+    ('Strain', 'select term = strain from PRB_Strain'),
+    ('Tissue', 'select term = tissue from PRB_Tissue'),
+    ('Gender', 'select term = t.term from VOC_Term t, VOC_Vocab v ' + \
+	'where v.name = "Gender" and v._Vocab_key = t._Vocab_key'),
+    ('Cell Line', 'select term = t.term from VOC_Term t, VOC_Vocab v ' + \
+	'where v.name = "Cell Line" and v._Vocab_key = t._Vocab_key'),
+    ('User', 'select term = login from MGI_User'),
+    ]
+
+# vocabulary of each field of a parsed record (libraryload.py format, 0-based)
+fieldVocabularies = [
+    (1, 'Logical DB'),
+    (3, 'Segment Type'),
+    (4, 'Vector Type'),
+    (5, 'Organism'),
+    (6, 'Strain'),
+    (7, 'Tissue'),
+    (9, 'Gender'),
+    (10, 'Cell Line'),
+    ]
+
+# Created By is the last field of a parsed record
+userVocabulary = 'User'
+
+def readSnapshot(
+    fileName	# snapshot file name (string)
+    ):
+    # Purpose: read a vocabulary snapshot
+    # Returns: dictionary of vocabulary name -> dictionary of terms
+    # Assumes: nothing
+    # Effects: reads the snapshot file
+    # Throws: IOError if the file cannot be read
+
+    snapshot = {}
+
+    fp = open(fileName, 'r')
+    for line in fp.readlines():
+        tokens = string.split(line[:-1], TAB)
+        if len(tokens) < 2:
+            continue
+        if not snapshot.has_key(tokens[0]):
+            snapshot[tokens[0]] = {}
+        snapshot[tokens[0]][tokens[1]] = 1
+    fp.close()
+
+    return snapshot
+
+def validateRecord(
+    snapshot,	# dictionary returned by readSnapshot()
+    fields	# list of parsed record fields
+    ):
+    # Purpose: validate each vocabulary field of a parsed record
+    #          empty values are not validated
+    # Returns: list of (vocabulary, term) that are not in the snapshot
+    # Assumes: nothing
+    # Effects: nothing
+    # Throws: nothing
+
+    errors = []
+
+    for i, vocabulary in fieldVocabularies + [(len(fields) - 1, userVocabulary)]:
+        if not snapshot.has_key(vocabulary) or i >= len(fields):
+            continue
+        term = fields[i]
+        if len(term) > 0 and not snapshot[vocabulary].has_key(term):
+            errors.append((vocabulary, term))
+
+    return errors
+
+def writeSnapshot(
+    fileName	# snapshot file name (string)
+    ):
+    # Purpose: write a snapshot of the current MGI vocabularies
+    # Returns: nothing
+    # Assumes: db user/password have been set
+    # Effects: queries the database; writes the snapshot file
+    # Throws: IOError if the file cannot be written
+
+    import db
+
+    fp = open(fileName, 'w')
+    for vocabulary, cmd in vocabQueries:
+        for r in db.sql(cmd, 'auto'):
+            fp.write(vocabulary + TAB + str(r['term']) + CRT)
+    fp.close()
+
+    return
+
+#
+# Main
+#
+
+if __name__ == '__main__':
+
+    import getopt
+    import db
+
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], 'O:')
+    except:
+        optlist = []
+
+    outputFileName = ''
+    for opt in optlist:
+        if opt[0] == '-O':
+            outputFileName = opt[1]
+
+    if outputFileName == '':
+        sys.stderr.write('usage: %s -O snapshot file\n' % sys.argv[0])
+        sys.exit(1)
+
+    db.useOneConnection(1)
+    db.set_sqlUser(os.environ['MGD_DBUSER'])
+    db.set_sqlPasswordFromFile(os.environ['MGD_DBPASSWORDFILE'])
+
+    try:
+        writeSnapshot(outputFileName)
+    except IOError:
+        sys.stderr.write('Could not write file %s\n' % outputFileName)
+        db.useOneConnection(0)
+        sys.exit(1)
+
+    db.useOneConnection(0)
+    sys.exit(0)
+
@@ -12,7 +12,12 @@
 # Requirements Satisfied by This Program:
 #
 # Usage:
-#        niaparse.py -I input file
+#        niaparse.py [-I input file] [-C gz|bz2|xz] [-V vocabulary snapshot]
+#
+#	-I input file (default NIA_Lib_Source_Info.txt); may be gzip, bzip2 or xz compressed
+#	-C write the output and error files compressed
+#	-V validate translated values against a vocabulary snapshot (see libraryvocab.py);
+#	   records with invalid values are written to the error file, not the output file
 #
 # Envvars:
 #
@@ -47,7 +52,7 @@
 #
 # Outputs:
 #
-#	A tab-delimited file in the format:
+#	A tab-delimited file (input file + .lib) in the format:
 #		field 1: Library Name
 #		field 2: Library Accession Name
 #		field 3: Library ID
@@ -79,6 +84,7 @@
 #	def showUsage():	prints usage of this program and exits
 #	def exit():		prints message to stderr and exists
 #	def init():		processes inputs; initializes globals
+#	def writeLibrary():	validates and writes one parsed record
 #	def processFile():	processes input file
 #
 #	Algorithm:
@@ -91,6 +97,9 @@
 import sys
 import os
 import string
+import getopt
+import libraryio
+import libraryvocab
 
 #globals
 
@@ -103,6 +112,8 @@ errorFile = ''		# file descriptor of error file
 
 inFileName = 'NIA_Lib_Source_Info.txt'
 
+snapshot = None		# vocabulary snapshot (see libraryvocab.py)
+
 NS = 'Not Specified'
 segmentType = 'cDNA'
 organism = 'mouse, laboratory'
@@ -117,7 +128,7 @@ createdBy = 'library_load'
 # Throws:  nothing
  
 def showUsage():
-    usage = 'usage: %s -I input file\n' % sys.argv[0]
+    usage = 'usage: %s [-I input file] [-C gz|bz2|xz] [-V vocabulary snapshot]\n' % sys.argv[0]
     exit(1, usage)
  
 # Purpose: 
@@ -151,30 +162,82 @@ def exit(
 # Throws:  nothing
      
 def init():
-    global inFile, outputFile, errorFile
+    global inFile, outputFile, errorFile, inFileName, snapshot
+     
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], 'I:C:V:')
+    except:
+        showUsage()
      
     outputFileName = ''
+    compression = None
+    snapshotFileName = ''
      
-    outputFileName = inFileName + '.lib'
-    errorFileName = inFileName + '.error'
+    for opt in optlist:
+        if opt[0] == '-I':
+            inFileName = opt[1]
+        elif opt[0] == '-C':
+            compression = opt[1]
+        elif opt[0] == '-V':
+            snapshotFileName = opt[1]
+        else:
+            showUsage()
+
+    if compression is not None and compression not in libraryio.COMPRESSIONS:
+        showUsage()
+
+    baseFileName = libraryio.stripCompression(inFileName)
+    outputFileName = libraryio.outputName(baseFileName + '.lib', compression)
+    errorFileName = libraryio.outputName(baseFileName + '.error', compression)
 
     try:
-        inFile = open(inFileName, 'r')
+        inFile = libraryio.openFile(inFileName, 'r')
     except:
         exit(1, 'Could not open file %s\n' % inFileName)
 		    
+    if snapshotFileName != '':
+        try:
+            snapshot = libraryvocab.readSnapshot(snapshotFileName)
+        except:
+            exit(1, 'Could not open file %s\n' % snapshotFileName)
+
     try:
-        outputFile = open(outputFileName, 'w')
+        outputFile = libraryio.openFile(outputFileName, 'w')
     except:
         exit(1, 'Could not open file %s\n' % outputFileName)
 		    
     try:
-        errorFile = open(errorFileName, 'w')
+        errorFile = libraryio.openFile(errorFileName, 'w')
     except:
         exit(1, 'Could not open file %s\n' % errorFileName)
 		
     return
 
+# Purpose: write one parsed library record to the output file
+#          if a vocabulary snapshot was given, a record with any value
+#          not in the snapshot is written to the error file instead
+# Returns: nothing
+# Assumes: nothing
+# Effects: writes to output file or error file
+# Throws:  nothing
+
+def writeLibrary(
+    fields,	# list of output fields (libraryload.py format)
+    lineNum	# line number of the start of the record (integer)
+    ):
+
+    if snapshot is not None:
+        errors = libraryvocab.validateRecord(snapshot, fields)
+        if len(errors) > 0:
+            for vocabulary, term in errors:
+                errorFile.write('Invalid %s (line: %d): %s, Library = %s\n' \
+                    % (vocabulary, lineNum, term, fields[0]))
+            return
+
+    outputFile.write(string.join(fields, TAB) + CRT)
+
+    return
+
 # Purpose: read input file, write output file
 # Returns: nothing
 # Assumes: nothing
@@ -184,26 +247,17 @@ def init():
 def processFile():
 
     writeRecord = 0
+    lineNum = 0
 
     for line in inFile.readlines():
 
+        lineNum = lineNum + 1
+
 	if string.find(line[:-1], 'Name') >= 0:
 
             if writeRecord:
-                        outputFile.write(libraryName + TAB + \
-                            logicalDBName + TAB + \
-                            libraryID + TAB + \
-                            segmentType + TAB + \
-                            vectorType + TAB + \
-                            organism + TAB + \
-                            strain + TAB + \
-                            tissue + TAB + \
-                            age + TAB + \
-                            gender + TAB + \
-                            cellLine + TAB + \
-                            jnum + TAB + \
-                            note + TAB + \
-                            createdBy + CRT)
+                writeLibrary([libraryName, logicalDBName, libraryID, segmentType, vectorType, organism, \
+		    strain, tissue, age, gender, cellLine, jnum, note, createdBy], recordLineNum)
 
             [label, libraryName] = string.split(line[:-1], '\t')
 
@@ -217,6 +271,7 @@ def processFile():
             cellLine = ''
 
             writeRecord = 1
+            recordLineNum = lineNum
 
         elif string.find(line[:-1], 'NIA Library ID') >= 0:
 
@@ -382,20 +437,8 @@ def processFile():
 		strain = 'CD-1'
 
     if writeRecord:
-        outputFile.write(libraryName + TAB + \
-                         logicalDBName + TAB + \
-                         libraryID + TAB + \
-                         segmentType + TAB + \
-                         vectorType + TAB + \
-                         organism + TAB + \
-                         strain + TAB + \
-                         tissue + TAB + \
-                         age + TAB + \
-                         gender + TAB + \
-                         cellLine + TAB + \
-                         jnum + TAB + \
-                         note + TAB + \
-                         createdBy + CRT)
+        writeLibrary([libraryName, logicalDBName, libraryID, segmentType, vectorType, organism, \
+		strain, tissue, age, gender, cellLine, jnum, note, createdBy], recordLineNum)
 
     return
 